@@ -0,0 +1,225 @@
+#!/usr/local/bin/sage -python
+# -*- coding: iso-8859-15 -*-
+"""Throughput benchmarks for the db_solver.py pipeline."""
+# DO NOT EDIT DIRECTLY IF NOT IN cic-python-common, THIS FILE IS ORIGINALLY FROM https://github.com/akroshko/cic-python-common
+
+# Copyright (C) 2018-2019, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <akroshko.public+devel@gmail.com>
+# Created: Thu Aug 09, 2018
+# Version: 20191209
+# URL: https://github.com/akroshko/cic-python-common
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+
+# Usage:
+#
+#   db_benchmark.py <output.json> [--sqlite=path] [--cost=fixed|heavy-tailed|large-output]
+#                   [--problems=N] [--mean-time=seconds] [--output-size=N] [--seed=N]
+#                   [--binary] [--solver-flags='--chunksize=64 ...']
+#
+# Generates a synthetic batch table of dummy problems, runs
+# db_solver.py on it end-to-end against the local database and writes
+# the throughput figures to output.json.  --binary stores the
+# trajectories in a bytea (BLOB with SQLite) column.  db_solver.py imports the
+# dummy solver from this file, so nothing here runs on import.
+
+import os,sys
+import glob
+import json
+import random
+import socket
+import subprocess
+import time
+
+import numpy as np
+
+from db_common import *
+from db_defaults import *
+try:
+    from db_defaults_local import *
+except ImportError:
+    pass
+
+__all__=['BenchmarkSolver','BENCHMARK_METHOD_PROPERTIES','BENCHMARK_ODE_PROPERTIES']
+
+# bump if the layout of the output changes
+BENCHMARK_FORMAT='db_benchmark/1'
+
+BENCHMARK_METHOD_PROPERTIES={}
+BENCHMARK_ODE_PROPERTIES={}
+
+class BenchmarkSolver(object):
+    """A dummy solver object that spins the CPU for the number of seconds
+in the incoming property cost and returns an array of output_size
+floats."""
+    def __init__(self,method_default_properties=None,ode_default_properties=None,incoming_properties=None):
+        self.incoming_properties=incoming_properties
+
+    def run(self,theglobals):
+        cost=self.incoming_properties['cost']
+        output_size=self.incoming_properties['output_size']
+        end_time=time.time()+cost
+        result=0.0
+        while time.time() < end_time:
+            result+=1.0
+        thegenerator=random.Random(self.incoming_properties['seed'])
+        return {'result':result,
+                'trajectory':np.array([thegenerator.random() for i in xrange(output_size)])}
+
+def benchmark_costs(cost_model,number_of_problems,mean_time,seed):
+    """The cost in seconds of each problem.  heavy-tailed draws from a
+Pareto distribution with the same mean so a few problems take far
+longer than the rest."""
+    thegenerator=random.Random(seed)
+    if cost_model == 'heavy-tailed':
+        alpha=1.5
+        # mean of paretovariate is alpha/(alpha-1)
+        return [mean_time*thegenerator.paretovariate(alpha)*(alpha-1.0)/alpha for i in xrange(number_of_problems)]
+    else:
+        return [mean_time]*number_of_problems
+
+def benchmark_create_tables(BACKEND,CONNECTION,CURSOR,dbtable,batch_table,costs,output_size,seed,trajectory_type):
+    """Create a dbtable and batch table holding one dummy problem for
+each cost, dropping any left from an earlier run."""
+    CURSOR.execute("DROP TABLE IF EXISTS " + batch_table + ";")
+    CURSOR.execute("DROP TABLE IF EXISTS " + dbtable + ";")
+    CURSOR.execute("CREATE TABLE " + dbtable + " (solve_number integer PRIMARY KEY, solver_object text, method_properties text, ode_properties text, incoming_properties_keys " + BACKEND.text_array_type + ", outgoing_properties_keys " + BACKEND.text_array_type + ", cost double precision, output_size integer, seed integer, result double precision, trajectory " + trajectory_type + ', "worker time" double precision);')
+    CURSOR.execute("CREATE TABLE " + batch_table + " (table_name text, solve_number integer PRIMARY KEY, hostname text, done boolean);")
+    insert_string="INSERT INTO " + dbtable + " (solve_number,solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys,cost,output_size,seed) VALUES (" + ','.join([BACKEND.placeholder]*9) + ");"
+    CURSOR.executemany(insert_string,[(solve_number,'<<BenchmarkSolver>>','<<BENCHMARK_METHOD_PROPERTIES>>','<<BENCHMARK_ODE_PROPERTIES>>',['cost','output_size','seed'],['result','trajectory'],cost,output_size,seed+solve_number)
+                                      for solve_number,cost in enumerate(costs)])
+    insert_string="INSERT INTO " + batch_table + " (table_name,solve_number,hostname,done) VALUES (" + ','.join([BACKEND.placeholder]*4) + ");"
+    CURSOR.executemany(insert_string,[(dbtable,solve_number,None,False) for solve_number in xrange(len(costs))])
+    CONNECTION.commit()
+
+def benchmark_latest_metrics(batch_table,start_time):
+    """The last line of metrics.jsonl from the db_solver.py run that
+started after start_time."""
+    logdirs=glob.glob(os.path.join(os.path.expanduser(os.getenv('PYMATHDBTMP')),'db_solver_capture_output','db_solver_*_' + batch_table))
+    logdirs=[logdir for logdir in logdirs if os.path.getmtime(logdir) >= start_time-1.0]
+    if logdirs == []:
+        return None
+    metrics_path=os.path.join(max(logdirs,key=os.path.getmtime),'metrics.jsonl')
+    if not os.path.exists(metrics_path):
+        return None
+    fh=open(metrics_path,'r')
+    lines=fh.readlines()
+    fh.close()
+    return json.loads(lines[-1])
+
+def benchmark_settings(solver_output):
+    """The settings db_solver.py printed when it started."""
+    settings={'LIMITPERSEGMENT':LIMITPERSEGMENT,
+              'MAXUPDATESTRINGS':MAXUPDATESTRINGS}
+    for line in solver_output.splitlines():
+        for setting in ('PROCESSES','MAXTASKSPERCHILD'):
+            if line.startswith(setting + ': '):
+                settings[setting]=int(line[len(setting)+2:])
+    return settings
+
+def main(argv):
+    output_path=argv[1]
+    cost_model=db_argv_value('--cost','fixed')
+    if cost_model not in ('fixed','heavy-tailed','large-output'):
+        print("Unknown cost model: %s" % cost_model)
+        return 1
+    number_of_problems=int(db_argv_value('--problems','10000'))
+    mean_time=float(db_argv_value('--mean-time','0.001'))
+    if cost_model == 'large-output':
+        output_size=int(db_argv_value('--output-size','10000'))
+    else:
+        output_size=int(db_argv_value('--output-size','0'))
+    seed=int(db_argv_value('--seed','0'))
+    solver_flags=db_argv_value('--solver-flags','').split()
+    dbtable='db_benchmark_' + cost_model.replace('-','_')
+    batch_table=dbtable + '_batch'
+    BACKEND=db_backend()
+    CONNECTION,CURSOR=BACKEND.connect()
+    print("==== Creating %s problems in %s ====" % (number_of_problems,dbtable))
+    sys.stdout.flush()
+    costs=benchmark_costs(cost_model,number_of_problems,mean_time,seed)
+    binary_flag='--binary' in sys.argv
+    if binary_flag:
+        trajectory_type=BACKEND.binary_type
+    else:
+        trajectory_type=BACKEND.float_array_type
+    benchmark_create_tables(BACKEND,CONNECTION,CURSOR,dbtable,batch_table,costs,output_size,seed,trajectory_type)
+    # --claim so no db_watcher.py is needed, ignored with SQLite
+    command_list=[sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),'db_solver.py'),
+                  os.path.dirname(os.path.abspath(__file__)),'db_benchmark',batch_table,'--claim'] + solver_flags
+    if db_argv_value('--sqlite') is not None:
+        command_list.append('--sqlite=' + db_argv_value('--sqlite'))
+    print("==== Running: %s ====" % ' '.join(command_list))
+    sys.stdout.flush()
+    start_time=time.time()
+    p=subprocess.Popen(command_list,stdout=subprocess.PIPE)
+    solver_output=p.communicate()[0]
+    wall_time=time.time()-start_time
+    if p.returncode != 0:
+        print(solver_output)
+        print("db_solver.py failed with return code: %s" % p.returncode)
+        return 1
+    settings=benchmark_settings(solver_output)
+    CURSOR.execute("SELECT count(*) FROM " + batch_table + " WHERE done=" + BACKEND.placeholder + ";",(True,))
+    number_done=CURSOR.fetchall()[0][0]
+    CURSOR.execute('SELECT sum("worker time") FROM ' + dbtable + ";")
+    worker_time_total=CURSOR.fetchall()[0][0] or 0.0
+    CONNECTION.commit()
+    CONNECTION.close()
+    metrics=benchmark_latest_metrics(batch_table,start_time)
+    phases={}
+    coordinator_time=0.0
+    if metrics is not None:
+        phases=metrics['phases']
+        # time the main thread spends on anything but waiting for
+        # results, fetching and writing back happen on their own
+        # threads at the same time so are not counted
+        coordinator_time=metrics['elapsed']-phases.get('queue wait',{'total':0.0})['total']
+    results={'problems':number_of_problems,
+             'problems done':number_done,
+             'wall time':wall_time,
+             'problems per second':number_done/wall_time,
+             'worker time total':worker_time_total,
+             'coordinator overhead per task':coordinator_time/max(number_done,1),
+             'core utilisation':worker_time_total/(wall_time*settings.get('PROCESSES',1))}
+    if 'commit' in phases:
+        results['commit latency mean']=phases['commit']['total']/phases['commit']['count']
+        results['commit latency max']=phases['commit']['max']
+    record={'format':BENCHMARK_FORMAT,
+            'timestamp':timestamp_now(),
+            'host':socket.gethostname(),
+            'parameters':{'backend':'sqlite' if db_argv_value('--sqlite') is not None else 'postgres',
+                          'binary':binary_flag,
+                          'cost':cost_model,
+                          'mean time':mean_time,
+                          'output size':output_size,
+                          'seed':seed,
+                          'solver flags':solver_flags},
+            'settings':settings,
+            'results':results,
+            'phases':phases}
+    fh=open(output_path,'w')
+    json.dump(record,fh,sort_keys=True,indent=2)
+    fh.write('\n')
+    fh.close()
+    pprint(results)
+    return 0
+
+if __name__ == '__main__':
+    from pymath_common import *
+    pymath_default_imports(globals(),locals())
+    sys.exit(main(sys.argv))
@@ -0,0 +1,876 @@
+#!/usr/local/bin/sage -python
+# -*- coding: iso-8859-15 -*-
+"""Batch table operations shared by db_solver.py and db_watcher.py."""
+# DO NOT EDIT DIRECTLY IF NOT IN cic-python-common, THIS FILE IS ORIGINALLY FROM https://github.com/akroshko/cic-python-common
+
+# Copyright (C) 2018-2019, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <akroshko.public+devel@gmail.com>
+# Created: Thu Aug 09, 2018
+# Version: 20191209
+# URL: https://github.com/akroshko/cic-python-common
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+
+import os,sys
+import binascii
+import cPickle
+from cStringIO import StringIO
+import json
+import math as m
+import multiprocessing
+import select
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from pymath_common import open_database
+
+__all__=['DbMetrics','DbPostgresBackend','DbResultCache','DbSqliteBackend','assign_work_chunk','claim_work_chunk','db_argv_value','db_array_decode','db_array_encode','db_array_value','db_backend','db_host_capacity','db_lease_free','db_lease_table','db_listen','db_notify','db_wait_for_event']
+
+def db_lease_table(batch_table):
+    """The table of leases for batch_table, one row per host with when
+its lease on everything assigned to it expires."""
+    return batch_table + '_leases'
+
+def db_lease_free(batch_table,alias):
+    """SQL condition that the row alias of batch_table is unassigned or
+assigned to a host without a live lease."""
+    lease_table=db_lease_table(batch_table)
+    return "(" + alias + ".hostname IS NULL OR NOT EXISTS (SELECT 1 FROM " + lease_table + " WHERE " + lease_table + ".hostname=" + alias + ".hostname AND " + lease_table + ".lease_expires >= now()))"
+
+def claim_work_chunk(CONNECTION,CURSOR,batch_table,hostname,number_to_claim,lease_time):
+    """Atomically assign up to number_to_claim unassigned problems to
+hostname, renew its lease for lease_time seconds, and commit.
+
+    Rows locked by another claim are skipped rather than waited on, so
+    any number of hosts can claim concurrently without ever getting the
+    same problem.  Problems of hosts whose lease has expired count as
+    unassigned.
+
+    **Returns**
+      list:
+        The (table_name,solve_number) pairs that were claimed.
+
+    """
+    CURSOR.execute("INSERT INTO " + db_lease_table(batch_table) + " (hostname,lease_expires) VALUES (%s,now()+%s*interval '1 second') ON CONFLICT (hostname) DO UPDATE SET lease_expires=EXCLUDED.lease_expires;",(hostname,lease_time))
+    claim_string="UPDATE " + batch_table + " AS b SET hostname=%s WHERE " + db_lease_free(batch_table,'b') + " AND b.ctid IN (SELECT s.ctid FROM " + batch_table + " AS s WHERE " + db_lease_free(batch_table,'s') + " AND s.done=FALSE LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING b.table_name,b.solve_number;"
+    CURSOR.execute(claim_string,(hostname,number_to_claim))
+    claimed=CURSOR.fetchall()
+    CONNECTION.commit()
+    return claimed
+
+def assign_work_chunk(CONNECTION,CURSOR,batch_table,hostname,number_to_assign,lease_time):
+    """Assign up to number_to_assign unassigned problems to hostname for
+db_watcher.py, a host without a lease gets one for lease_time seconds to
+start renewing it.  The caller commits."""
+    CURSOR.execute("INSERT INTO " + db_lease_table(batch_table) + " (hostname,lease_expires) VALUES (%s,now()+%s*interval '1 second') ON CONFLICT (hostname) DO NOTHING;",(hostname,lease_time))
+    assign_string="UPDATE " + batch_table + " AS b SET hostname=%s WHERE " + db_lease_free(batch_table,'b') + " AND b.ctid IN (SELECT s.ctid FROM " + batch_table + " AS s WHERE " + db_lease_free(batch_table,'s') + " AND s.done=FALSE LIMIT %s FOR UPDATE SKIP LOCKED);"
+    CURSOR.execute(assign_string,(hostname,number_to_assign))
+
+def db_argv_value(flag,default=None):
+    """Get the value of a flag given as --flag=value in sys.argv, or
+default if the flag is not given."""
+    for thearg in sys.argv:
+        if thearg.startswith(flag + '='):
+            return thearg[len(flag)+1:]
+    return default
+
+def db_host_capacity():
+    """Find the number of cores and the physical memory of this host.
+
+    **Returns**
+      tuple:
+        (cores,memory) with memory in bytes, or None if it cannot be
+        found.
+
+    """
+    cores=multiprocessing.cpu_count()
+    try:
+        memory=os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (ValueError,OSError,AttributeError):
+        memory=None
+    return cores,memory
+
+################################################################################
+## events through PostgreSQL LISTEN/NOTIFY, payloads are
+## 'assigned <hostname>' and 'done <hostname> <processes>'
+
+def db_event_channel(batch_table):
+    return batch_table + '_events'
+
+def db_notify(CURSOR,batch_table,payload):
+    """Queue an event for listeners on batch_table, it is delivered when
+the current transaction commits."""
+    CURSOR.execute("SELECT pg_notify(%s,%s);",(db_event_channel(batch_table),payload))
+
+def db_listen(batch_table):
+    """Open a seperate connection that listens for events on
+batch_table.  Autocommit so notifications are never held up behind an
+open transaction."""
+    LISTEN_CONNECTION,LISTEN_CURSOR=open_database(None,None)
+    LISTEN_CONNECTION.autocommit=True
+    LISTEN_CURSOR.execute('LISTEN "' + db_event_channel(batch_table) + '";')
+    return LISTEN_CONNECTION
+
+def db_wait_for_event(LISTEN_CONNECTION,timeout,accept=None):
+    """Block on the connection socket until an event arrives or timeout
+seconds pass.
+
+    **Parameters**
+      accept:
+        Optional function of the payload, events it rejects are
+        dropped and waiting continues.  Every payload that arrived is
+        passed to it, even after one is accepted.
+
+    **Returns**
+      bool:
+        True if an accepted event arrived, False on timeout.
+
+    """
+    end_time=time.time()+timeout
+    while True:
+        LISTEN_CONNECTION.poll()
+        payloads=[notify.payload for notify in LISTEN_CONNECTION.notifies]
+        del LISTEN_CONNECTION.notifies[:]
+        accepted=False
+        for payload in payloads:
+            if accept is None or accept(payload):
+                accepted=True
+        if accepted:
+            return True
+        remaining=end_time-time.time()
+        if remaining <= 0.0:
+            return False
+        select.select([LISTEN_CONNECTION],[],[],remaining)
+
+################################################################################
+## binary NumPy arrays, stored in bytea (PostgreSQL) or BLOB (SQLite)
+## columns as a short header followed by the raw buffer
+##
+## 'PMA1', compression (0 none, 1 zlib) and header length as '<BI',
+## then the header {"dtype":...,"shape":[...]} as JSON, then the data
+
+DB_ARRAY_MAGIC='PMA1'
+DB_ARRAY_PREFIX=struct.Struct('<BI')
+
+def db_array_encode(value,compression_level=0):
+    """Encode an ndarray as a binary string for a bytea or BLOB column.
+
+    **Parameters**
+      value:
+        An ndarray of any dtype except object.
+      compression_level:
+        The zlib compression level, or 0 for no compression.
+
+    **Returns**
+      string:
+        The encoded array.
+
+    """
+    if value.dtype.hasobject:
+        raise TypeError("No binary encoding for dtype: %s" % value.dtype)
+    header=json.dumps({'dtype':value.dtype.str,'shape':list(value.shape)})
+    data=np.ascontiguousarray(value).tostring()
+    if compression_level > 0:
+        data=zlib.compress(data,compression_level)
+        compression=1
+    else:
+        compression=0
+    return DB_ARRAY_MAGIC + DB_ARRAY_PREFIX.pack(compression,len(header)) + header + data
+
+def db_array_decode(data):
+    """Decode what db_array_encode wrote.  Uncompressed arrays are a
+read-only view of data rather than a copy."""
+    header_start=len(DB_ARRAY_MAGIC)+DB_ARRAY_PREFIX.size
+    compression,header_length=DB_ARRAY_PREFIX.unpack(data[len(DB_ARRAY_MAGIC):header_start])
+    header=json.loads(str(data[header_start:header_start+header_length]))
+    dtype=np.dtype(str(header['dtype']))
+    if np.prod(header['shape']) == 0:
+        # frombuffer will not take an empty buffer
+        return np.zeros(header['shape'],dtype)
+    elif compression == 1:
+        return np.frombuffer(zlib.decompress(data[header_start+header_length:]),dtype).reshape(header['shape'])
+    else:
+        return np.frombuffer(data,dtype,offset=header_start+header_length).reshape(header['shape'])
+
+def db_array_value(value):
+    """Decode value if it is an encoded array from a bytea or BLOB
+column, otherwise return it unchanged."""
+    if isinstance(value,(buffer,bytearray)) and str(value[:len(DB_ARRAY_MAGIC)]) == DB_ARRAY_MAGIC:
+        return db_array_decode(value)
+    return value
+
+def db_array_encode_rows(rows,binary_columns,compression_level):
+    """Encode the ndarray values in binary_columns of
+(solve_number,outgoing_properties_dict) rows, ready for either
+backend to write as bytea or BLOB."""
+    if not binary_columns:
+        return rows
+    encoded_rows=[]
+    for solve_number,outgoing_properties_dict in rows:
+        encoded_dict=dict(outgoing_properties_dict)
+        for k in binary_columns:
+            if isinstance(encoded_dict.get(k),np.ndarray):
+                encoded_dict[k]=buffer(db_array_encode(encoded_dict[k],compression_level))
+        encoded_rows.append((solve_number,encoded_dict))
+    return encoded_rows
+
+################################################################################
+## COPY text format for PostgreSQL
+
+def db_copy_text_array_element(value):
+    """Convert one element of a list or array to the PostgreSQL array
+literal syntax."""
+    if isinstance(value,(list,tuple,np.ndarray)):
+        return '{' + ','.join([db_copy_text_array_element(v) for v in value]) + '}'
+    elif value is None:
+        return 'NULL'
+    elif isinstance(value,basestring):
+        if isinstance(value,unicode):
+            value=value.encode('utf-8')
+        return '"' + value.replace('\\','\\\\').replace('"','\\"') + '"'
+    else:
+        return db_copy_text_scalar(value)
+
+def db_copy_text_scalar(value):
+    """Convert a scalar to the text that COPY expects, before
+escaping."""
+    if isinstance(value,(bool,np.bool_)):
+        return 't' if value else 'f'
+    elif isinstance(value,(int,long,np.integer)):
+        return str(int(value))
+    elif isinstance(value,(float,np.floating)):
+        value=float(value)
+        if m.isnan(value):
+            return 'NaN'
+        elif m.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    elif isinstance(value,unicode):
+        return value.encode('utf-8')
+    elif isinstance(value,str):
+        return value
+    elif isinstance(value,dict):
+        return json.dumps(value)
+    elif isinstance(value,(buffer,bytearray)):
+        # bytea hex format
+        return '\\x' + binascii.hexlify(str(value))
+    else:
+        # caller falls back to UPDATE statements for these
+        raise TypeError("No COPY conversion for: %s" % type(value))
+
+def db_copy_text(value):
+    """Convert a value to one field of a COPY text-format row."""
+    if value is None:
+        return '\\N'
+    if isinstance(value,(list,tuple,np.ndarray)):
+        thestring=db_copy_text_array_element(value)
+    else:
+        thestring=db_copy_text_scalar(value)
+    return thestring.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+################################################################################
+## storage backends, everything db_solver.py and db_watcher.py do to
+## the database goes through one of these
+
+class DbPostgresBackend(object):
+    """The PostgreSQL database given by open_database, shared by all
+hosts."""
+    # more than one host can work from this database
+    shared=True
+    # for building tables and statements that work with either backend
+    placeholder='%s'
+    text_array_type='text[]'
+    float_array_type='double precision[]'
+    binary_type='bytea'
+    # database time so the clocks of the hosts do not matter
+    lease_type='timestamp with time zone'
+    # zlib level for ndarrays written to binary columns, 0 is none
+    array_compression=0
+
+    def __init__(self):
+        # dbtable -> columns of binary_type
+        self.binary_columns_cache={}
+
+    def connect(self):
+        return open_database(None,None)
+
+    def binary_columns(self,CURSOR,dbtable):
+        """The bytea columns of dbtable, these get ndarrays as
+db_array_encode binary rather than as array literals."""
+        if dbtable not in self.binary_columns_cache:
+            CURSOR.execute("SELECT attname FROM pg_attribute WHERE attrelid=%s::regclass AND atttypid='bytea'::regtype AND attnum > 0 AND NOT attisdropped;",(dbtable,))
+            self.binary_columns_cache[dbtable]=set([row[0] for row in CURSOR.fetchall()])
+        return self.binary_columns_cache[dbtable]
+
+    def select_pending(self,CURSOR,batch_table,hostname=None,limit=None,exclude=None):
+        """Select (table_name,solve_number) for problems that are not done.
+
+        **Parameters**
+          hostname:
+            Only problems assigned to hostname, or any problem if None.
+          exclude:
+            solve_numbers to leave out, generally those in flight.
+
+        """
+        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE"
+        parameters=[]
+        if hostname is not None:
+            selected_batch_string+=" AND hostname=%s"
+            parameters.append(hostname)
+        if exclude:
+            selected_batch_string+=" AND NOT (solve_number = ANY(%s))"
+            parameters.append(list(exclude))
+        if limit is not None:
+            selected_batch_string+=" LIMIT %s"
+            parameters.append(limit)
+        CURSOR.execute(selected_batch_string + ";",parameters)
+        return CURSOR.fetchall()
+
+    def select_unassigned(self,CURSOR,batch_table,limit=None):
+        selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE"
+        if limit is not None:
+            selected_unassigned_string+=" LIMIT " + str(int(limit))
+        CURSOR.execute(selected_unassigned_string + ";")
+        return CURSOR.fetchall()
+
+    def count_problems(self,CURSOR,batch_table):
+        CURSOR.execute("SELECT count(*) FROM " + batch_table + ";")
+        return CURSOR.fetchall()[0][0]
+
+    def count_pending(self,CURSOR,batch_table,hostname):
+        CURSOR.execute("SELECT count(*) FROM " + batch_table + " WHERE hostname=%s AND done=FALSE;",(hostname,))
+        return CURSOR.fetchall()[0][0]
+
+    def count_by_host(self,CURSOR,batch_table):
+        """Count the problems pending and done for every hostname in one
+pass over batch_table.
+
+        **Returns**
+          dict:
+            hostname -> (number_pending,number_done), with None as the
+            hostname of unassigned problems.
+
+        """
+        CURSOR.execute("SELECT hostname,count(*) FILTER (WHERE done=FALSE),count(*) FILTER (WHERE done=TRUE) FROM " + batch_table + " GROUP BY hostname;")
+        return dict([(row[0],(row[1],row[2])) for row in CURSOR.fetchall()])
+
+    def claim(self,CONNECTION,CURSOR,batch_table,hostname,number_to_claim,lease_time):
+        """Claim work for hostname and commit, returns the number of
+problems claimed."""
+        return len(claim_work_chunk(CONNECTION,CURSOR,batch_table,hostname,number_to_claim,lease_time))
+
+    def assign(self,CONNECTION,CURSOR,batch_table,hostname,number_to_assign,lease_time):
+        assign_work_chunk(CONNECTION,CURSOR,batch_table,hostname,number_to_assign,lease_time)
+        return CURSOR.rowcount
+
+    def reassign(self,CONNECTION,CURSOR,batch_table,from_hostname,to_hostname,number_to_reassign):
+        """Move up to number_to_reassign problems that are not done from
+from_hostname to to_hostname, returns the number moved.  db_solver.py
+dispatches in order of solve_number and holds back all but a few chunks
+per process, so the highest solve_numbers are the ones it has not sent
+to its pool yet.  The caller commits."""
+        CURSOR.execute("UPDATE " + batch_table + " SET hostname=%s WHERE hostname=%s AND ctid IN (SELECT ctid FROM " + batch_table + " WHERE hostname=%s AND done=FALSE ORDER BY solve_number DESC LIMIT %s FOR UPDATE SKIP LOCKED);",(to_hostname,from_hostname,from_hostname,number_to_reassign))
+        return CURSOR.rowcount
+
+    def select_assigned(self,CURSOR,batch_table,hostname,solve_numbers):
+        """The set of solve_numbers that are still assigned to hostname
+and not done."""
+        CURSOR.execute("SELECT solve_number FROM " + batch_table + " WHERE hostname=%s AND done=FALSE AND solve_number = ANY(%s);",(hostname,list(solve_numbers)))
+        return set([row[0] for row in CURSOR.fetchall()])
+
+    def create_lease_table(self,CONNECTION,CURSOR,batch_table):
+        """Create the table of leases for batch_table if it is not
+there, and commit."""
+        CURSOR.execute("SELECT to_regclass(%s);",(db_lease_table(batch_table),))
+        if CURSOR.fetchall()[0][0] is None:
+            CURSOR.execute("CREATE TABLE IF NOT EXISTS " + db_lease_table(batch_table) + " (hostname text PRIMARY KEY, lease_expires " + self.lease_type + ");")
+        CONNECTION.commit()
+
+    def renew_leases(self,CURSOR,batch_table,hostname,lease_time):
+        """Extend the lease on everything assigned to hostname, a single
+row however much work it has.  The caller commits."""
+        CURSOR.execute("INSERT INTO " + db_lease_table(batch_table) + " (hostname,lease_expires) VALUES (%s,now()+%s*interval '1 second') ON CONFLICT (hostname) DO UPDATE SET lease_expires=EXCLUDED.lease_expires;",(hostname,lease_time))
+
+    def expire_leases(self,CURSOR,batch_table):
+        """Unassign problems of hosts whose lease has expired.  The caller
+commits.
+
+        **Returns**
+          dict:
+            hostname -> the number of its problems unassigned.
+
+        """
+        CURSOR.execute("DELETE FROM " + db_lease_table(batch_table) + " WHERE lease_expires < now();")
+        # rows being marked done are skipped, they are not lost
+        CURSOR.execute("WITH expired AS (SELECT ctid,hostname FROM " + batch_table + " AS s WHERE s.hostname IS NOT NULL AND s.done=FALSE AND " + db_lease_free(batch_table,'s') + " FOR UPDATE SKIP LOCKED) UPDATE " + batch_table + " SET hostname=NULL FROM expired WHERE " + batch_table + ".ctid=expired.ctid RETURNING expired.hostname;")
+        number_expired={}
+        for row in CURSOR.fetchall():
+            number_expired[row[0]]=number_expired.get(row[0],0)+1
+        return number_expired
+
+    def select_solved(self,CURSOR,dbtable,columns,limit):
+        """Select solve_number followed by columns for up to limit
+problems in dbtable that already have a worker time."""
+        columns_quoted=['"' + c + '"' for c in columns]
+        CURSOR.execute("SELECT " + ','.join(['solve_number'] + columns_quoted) + " FROM " + dbtable + ' WHERE "worker time" IS NOT NULL LIMIT %s;',(limit,))
+        return CURSOR.fetchall()
+
+    def select_problems(self,CURSOR,dbtable,columns,solve_numbers):
+        """Select solve_number followed by columns for every problem in
+solve_numbers."""
+        columns_quoted=['"' + c + '"' for c in columns]
+        CURSOR.execute("SELECT " + ','.join(['solve_number'] + columns_quoted) + " FROM " + dbtable + " WHERE solve_number = ANY(%s);",(list(solve_numbers),))
+        return CURSOR.fetchall()
+
+    def write_results(self,CURSOR,staging_number,dbtable,outgoing_properties_keys,rows,metrics):
+        """Write (solve_number,outgoing_properties_dict) rows that all
+have outgoing_properties_keys to dbtable.
+
+        Rows are COPY'd into a temporary staging table and applied with
+        one UPDATE ... FROM.  If a value cannot be represented as COPY
+        text, the rows are written with one UPDATE each instead.
+        ndarrays going to bytea columns are written as db_array_encode
+        binary.
+
+        """
+        binary_columns=self.binary_columns(CURSOR,dbtable).intersection(outgoing_properties_keys)
+        with metrics.phase('update build'):
+            rows=db_array_encode_rows(rows,binary_columns,self.array_compression)
+        try:
+            self._copy_and_update(CURSOR,staging_number,dbtable,outgoing_properties_keys,rows,metrics)
+        except TypeError:
+            # something COPY text cannot represent, let psycopg2 adapt it
+            self._update_each(CURSOR,dbtable,outgoing_properties_keys,rows,metrics)
+
+    def _copy_and_update(self,CURSOR,staging_number,dbtable,outgoing_properties_keys,rows,metrics):
+        # convert everything before touching the database
+        with metrics.phase('update build'):
+            buf=StringIO()
+            for solve_number,outgoing_properties_dict in rows:
+                buf.write('\t'.join([str(solve_number)] + [db_copy_text(outgoing_properties_dict[k]) for k in outgoing_properties_keys]))
+                buf.write('\n')
+            buf.seek(0)
+        staging_table="db_solver_staging_" + str(staging_number)
+        outgoing_properties_keys_quoted=['"' + k + '"' for k in outgoing_properties_keys]
+        columns=','.join(['solve_number'] + outgoing_properties_keys_quoted)
+        set_strings=[k + '=s.' + k for k in outgoing_properties_keys_quoted]
+        with metrics.phase('execute'):
+            # LIMIT 0 copies the column types without any rows
+            CURSOR.execute("CREATE TEMP TABLE " + staging_table + " AS SELECT " + columns + " FROM " + dbtable + " LIMIT 0;")
+            CURSOR.copy_expert("COPY " + staging_table + " (" + columns + ") FROM STDIN;",buf)
+            CURSOR.execute("UPDATE " + dbtable + " AS t SET " + ', '.join(set_strings) + " FROM " + staging_table + " AS s WHERE t.solve_number=s.solve_number;")
+            CURSOR.execute("DROP TABLE " + staging_table + ";")
+
+    def _update_each(self,CURSOR,dbtable,outgoing_properties_keys,rows,metrics):
+        outgoing_properties_strings = ['\"' + k + '\"=%(' + k + ')s' for k in outgoing_properties_keys]
+        with metrics.phase('update build'):
+            update_strings=[]
+            for solve_number,outgoing_properties_dict in rows:
+                outgoing_properties_update_string="UPDATE " + dbtable + " SET " + ', '.join(outgoing_properties_strings) + " WHERE solve_number=" + str(solve_number) + ";"
+                update_strings.append(CURSOR.mogrify(outgoing_properties_update_string,outgoing_properties_dict))
+        with metrics.phase('execute'):
+            CURSOR.execute(''.join(update_strings))
+
+    def mark_done(self,CURSOR,batch_table,solve_numbers):
+        CURSOR.execute("UPDATE " + batch_table + " SET done=TRUE WHERE solve_number = ANY(%s);",(list(solve_numbers),))
+
+    def mark_failed(self,CURSOR,batch_table,failures):
+        """Settle problems that failed for good as done, failures are
+(solve_number,error,attempts)."""
+        CURSOR.executemany("UPDATE " + batch_table + " SET done=TRUE,error=%s,attempts=%s WHERE solve_number=%s;",[(error,attempts,solve_number) for solve_number,error,attempts in failures])
+
+    def mark_timed_out(self,CURSOR,batch_table,timeouts):
+        """Settle problems that ran past their time budget as done,
+timeouts are (solve_number,elapsed)."""
+        CURSOR.executemany("UPDATE " + batch_table + " SET done=TRUE,timed_out=TRUE,elapsed=%s WHERE solve_number=%s;",[(elapsed,solve_number) for solve_number,elapsed in timeouts])
+
+    def add_columns(self,CONNECTION,CURSOR,table,columns):
+        """Add (name,type) columns to table unless they are already
+there, and commit."""
+        # ALTER TABLE locks out every other host even if the column is
+        # already there, so only for the ones that are missing
+        CURSOR.execute("SELECT attname FROM pg_attribute WHERE attrelid=%s::regclass AND attnum > 0 AND NOT attisdropped;",(table,))
+        existing=set([row[0] for row in CURSOR.fetchall()])
+        for name,thetype in columns:
+            if name not in existing:
+                CURSOR.execute("ALTER TABLE " + table + " ADD COLUMN IF NOT EXISTS \"" + name + "\" " + thetype + ";")
+        CONNECTION.commit()
+
+    def notify(self,CURSOR,batch_table,payload):
+        db_notify(CURSOR,batch_table,payload)
+
+    def listen(self,batch_table):
+        return db_listen(batch_table)
+
+    def wait_for_event(self,LISTEN_CONNECTION,timeout,accept=None):
+        return db_wait_for_event(LISTEN_CONNECTION,timeout,accept)
+
+def db_sqlite_json(value):
+    return json.dumps(value)
+
+def db_sqlite_ndarray(value):
+    return json.dumps(value.tolist())
+
+class DbSqliteBackend(object):
+    """An embedded SQLite database in a single file, for runs on a
+single host with no database server.
+
+    Tables have the same columns as with PostgreSQL.  Columns declared
+    with type JSON hold lists (e.g., incoming_properties_keys) and
+    dictionaries, done is stored as 0 or 1.  WAL mode lets the
+    prefetcher and the coordinator read while the other writes.
+
+    """
+    # no other host can see this database
+    shared=False
+    placeholder='?'
+    text_array_type='JSON'
+    float_array_type='JSON'
+    binary_type='BLOB'
+    # seconds since the epoch, there is only this host's clock
+    lease_type='REAL'
+    array_compression=0
+    # stay well under the default SQLITE_MAX_VARIABLE_NUMBER
+    max_variables=500
+
+    def __init__(self,path,timeout=60.0,poll_interval=1.0):
+        self.path=os.path.expanduser(path)
+        self.timeout=timeout
+        self.poll_interval=poll_interval
+        self.binary_columns_cache={}
+        for thetype in (list,tuple,dict):
+            sqlite3.register_adapter(thetype,db_sqlite_json)
+        sqlite3.register_adapter(np.ndarray,db_sqlite_ndarray)
+        for thetype in (np.float32,np.float64):
+            sqlite3.register_adapter(thetype,float)
+        for thetype in (np.int8,np.int16,np.int32,np.int64,np.uint8,np.uint16,np.uint32,np.uint64):
+            sqlite3.register_adapter(thetype,int)
+        sqlite3.register_adapter(np.bool_,bool)
+        sqlite3.register_converter('JSON',json.loads)
+
+    def connect(self):
+        CONNECTION=sqlite3.connect(self.path,timeout=self.timeout,detect_types=sqlite3.PARSE_DECLTYPES,check_same_thread=False)
+        CONNECTION.execute("PRAGMA journal_mode=WAL;")
+        CONNECTION.execute("PRAGMA synchronous=NORMAL;")
+        return CONNECTION,CONNECTION.cursor()
+
+    def binary_columns(self,CURSOR,dbtable):
+        if dbtable not in self.binary_columns_cache:
+            CURSOR.execute("PRAGMA table_info(" + dbtable + ");")
+            self.binary_columns_cache[dbtable]=set([row[1] for row in CURSOR.fetchall() if row[2].lower() in ('blob','bytea')])
+        return self.binary_columns_cache[dbtable]
+
+    def _in_chunks(self,values):
+        values=list(values)
+        for i in xrange(0,len(values),self.max_variables):
+            yield values[i:i+self.max_variables]
+
+    def select_pending(self,CURSOR,batch_table,hostname=None,limit=None,exclude=None):
+        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=0"
+        parameters=[]
+        if hostname is not None:
+            selected_batch_string+=" AND hostname=?"
+            parameters.append(hostname)
+        if exclude:
+            exclude=set(exclude)
+        if limit is not None:
+            # select enough extra to make up for anything excluded
+            selected_batch_string+=" LIMIT " + str(int(limit)+(len(exclude) if exclude else 0))
+        CURSOR.execute(selected_batch_string + ";",parameters)
+        selected=CURSOR.fetchall()
+        if exclude:
+            selected=[row for row in selected if row[1] not in exclude]
+            if limit is not None:
+                selected=selected[:limit]
+        return selected
+
+    def select_unassigned(self,CURSOR,batch_table,limit=None):
+        selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=0"
+        if limit is not None:
+            selected_unassigned_string+=" LIMIT " + str(int(limit))
+        CURSOR.execute(selected_unassigned_string + ";")
+        return CURSOR.fetchall()
+
+    def count_problems(self,CURSOR,batch_table):
+        CURSOR.execute("SELECT count(*) FROM " + batch_table + ";")
+        return CURSOR.fetchall()[0][0]
+
+    def count_pending(self,CURSOR,batch_table,hostname):
+        CURSOR.execute("SELECT count(*) FROM " + batch_table + " WHERE hostname=? AND done=0;",(hostname,))
+        return CURSOR.fetchall()[0][0]
+
+    def count_by_host(self,CURSOR,batch_table):
+        CURSOR.execute("SELECT hostname,sum(CASE WHEN done THEN 0 ELSE 1 END),sum(CASE WHEN done THEN 1 ELSE 0 END) FROM " + batch_table + " GROUP BY hostname;")
+        return dict([(row[0],(row[1],row[2])) for row in CURSOR.fetchall()])
+
+    def lease_free(self,batch_table,alias):
+        # time.time() in place of now(), there is only this host's clock
+        return db_lease_free(batch_table,alias).replace('now()','?')
+
+    def assign(self,CONNECTION,CURSOR,batch_table,hostname,number_to_assign,lease_time):
+        now=time.time()
+        CURSOR.execute("INSERT OR IGNORE INTO " + db_lease_table(batch_table) + " (hostname,lease_expires) VALUES (?,?);",(hostname,now+lease_time))
+        # a single statement holds the write lock throughout, so this is
+        # atomic without any row locking
+        CURSOR.execute("UPDATE " + batch_table + " SET hostname=? WHERE rowid IN (SELECT s.rowid FROM " + batch_table + " AS s WHERE " + self.lease_free(batch_table,'s') + " AND s.done=0 LIMIT ?);",(hostname,now,number_to_assign))
+        return CURSOR.rowcount
+
+    def reassign(self,CONNECTION,CURSOR,batch_table,from_hostname,to_hostname,number_to_reassign):
+        CURSOR.execute("UPDATE " + batch_table + " SET hostname=? WHERE rowid IN (SELECT rowid FROM " + batch_table + " WHERE hostname=? AND done=0 ORDER BY solve_number DESC LIMIT ?);",(to_hostname,from_hostname,number_to_reassign))
+        return CURSOR.rowcount
+
+    def select_assigned(self,CURSOR,batch_table,hostname,solve_numbers):
+        assigned=set()
+        for solve_numbers_chunk in self._in_chunks(solve_numbers):
+            CURSOR.execute("SELECT solve_number FROM " + batch_table + " WHERE hostname=? AND done=0 AND solve_number IN (" + ','.join(['?']*len(solve_numbers_chunk)) + ");",[hostname] + solve_numbers_chunk)
+            assigned.update([row[0] for row in CURSOR.fetchall()])
+        return assigned
+
+    def create_lease_table(self,CONNECTION,CURSOR,batch_table):
+        CURSOR.execute("CREATE TABLE IF NOT EXISTS " + db_lease_table(batch_table) + " (hostname TEXT PRIMARY KEY, lease_expires " + self.lease_type + ");")
+        CONNECTION.commit()
+
+    def renew_leases(self,CURSOR,batch_table,hostname,lease_time):
+        CURSOR.execute("INSERT OR REPLACE INTO " + db_lease_table(batch_table) + " (hostname,lease_expires) VALUES (?,?);",(hostname,time.time()+lease_time))
+
+    def expire_leases(self,CURSOR,batch_table):
+        now=time.time()
+        CURSOR.execute("DELETE FROM " + db_lease_table(batch_table) + " WHERE lease_expires < ?;",(now,))
+        # the same write transaction as the delete, so nothing renews
+        # in between
+        CURSOR.execute("SELECT s.hostname,count(*) FROM " + batch_table + " AS s WHERE s.hostname IS NOT NULL AND s.done=0 AND " + self.lease_free(batch_table,'s') + " GROUP BY s.hostname;",(now,))
+        number_expired=dict(CURSOR.fetchall())
+        CURSOR.execute("UPDATE " + batch_table + " SET hostname=NULL WHERE rowid IN (SELECT s.rowid FROM " + batch_table + " AS s WHERE s.hostname IS NOT NULL AND s.done=0 AND " + self.lease_free(batch_table,'s') + ");",(now,))
+        return number_expired
+
+    def claim(self,CONNECTION,CURSOR,batch_table,hostname,number_to_claim,lease_time):
+        self.renew_leases(CURSOR,batch_table,hostname,lease_time)
+        number_claimed=self.assign(CONNECTION,CURSOR,batch_table,hostname,number_to_claim,lease_time)
+        CONNECTION.commit()
+        return number_claimed
+
+    def select_solved(self,CURSOR,dbtable,columns,limit):
+        columns_quoted=['"' + c + '"' for c in columns]
+        CURSOR.execute("SELECT " + ','.join(['solve_number'] + columns_quoted) + " FROM " + dbtable + ' WHERE "worker time" IS NOT NULL LIMIT ?;',(limit,))
+        return CURSOR.fetchall()
+
+    def select_problems(self,CURSOR,dbtable,columns,solve_numbers):
+        columns_quoted=['"' + c + '"' for c in columns]
+        selected=[]
+        for solve_numbers_chunk in self._in_chunks(solve_numbers):
+            CURSOR.execute("SELECT " + ','.join(['solve_number'] + columns_quoted) + " FROM " + dbtable + " WHERE solve_number IN (" + ','.join(['?']*len(solve_numbers_chunk)) + ");",solve_numbers_chunk)
+            selected.extend(CURSOR.fetchall())
+        return selected
+
+    def write_results(self,CURSOR,staging_number,dbtable,outgoing_properties_keys,rows,metrics):
+        # no network round trips, so an executemany in one transaction
+        # is as good as a staging table here
+        outgoing_properties_strings=['"' + k + '"=?' for k in outgoing_properties_keys]
+        update_string="UPDATE " + dbtable + " SET " + ', '.join(outgoing_properties_strings) + " WHERE solve_number=?;"
+        binary_columns=self.binary_columns(CURSOR,dbtable).intersection(outgoing_properties_keys)
+        with metrics.phase('update build'):
+            rows=db_array_encode_rows(rows,binary_columns,self.array_compression)
+            parameters=[[outgoing_properties_dict[k] for k in outgoing_properties_keys] + [solve_number] for solve_number,outgoing_properties_dict in rows]
+        with metrics.phase('execute'):
+            CURSOR.executemany(update_string,parameters)
+
+    def mark_done(self,CURSOR,batch_table,solve_numbers):
+        CURSOR.executemany("UPDATE " + batch_table + " SET done=1 WHERE solve_number=?;",[(solve_number,) for solve_number in solve_numbers])
+
+    def mark_failed(self,CURSOR,batch_table,failures):
+        CURSOR.executemany("UPDATE " + batch_table + " SET done=1,error=?,attempts=? WHERE solve_number=?;",[(error,attempts,solve_number) for solve_number,error,attempts in failures])
+
+    def mark_timed_out(self,CURSOR,batch_table,timeouts):
+        CURSOR.executemany("UPDATE " + batch_table + " SET done=1,timed_out=1,elapsed=? WHERE solve_number=?;",[(elapsed,solve_number) for solve_number,elapsed in timeouts])
+
+    def add_columns(self,CONNECTION,CURSOR,table,columns):
+        # no ADD COLUMN IF NOT EXISTS in SQLite
+        CURSOR.execute("PRAGMA table_info(" + table + ");")
+        existing=set([row[1] for row in CURSOR.fetchall()])
+        for name,thetype in columns:
+            if name not in existing:
+                CURSOR.execute("ALTER TABLE " + table + " ADD COLUMN \"" + name + "\" " + thetype + ";")
+        CONNECTION.commit()
+
+    def notify(self,CURSOR,batch_table,payload):
+        # nobody else to tell
+        pass
+
+    def listen(self,batch_table):
+        return None
+
+    def wait_for_event(self,LISTEN_CONNECTION,timeout,accept=None):
+        # no events, so this is just a short wait before checking again
+        time.sleep(min(timeout,self.poll_interval))
+        return False
+
+def db_backend(array_compression=0):
+    """The backend given on the command line, --sqlite=path for an
+embedded SQLite database, otherwise PostgreSQL.  array_compression is
+the zlib level for ndarrays written to binary columns."""
+    sqlite_path=db_argv_value('--sqlite')
+    if sqlite_path is not None:
+        BACKEND=DbSqliteBackend(sqlite_path)
+    else:
+        BACKEND=DbPostgresBackend()
+    BACKEND.array_compression=array_compression
+    return BACKEND
+
+################################################################################
+## result cache
+
+class DbResultCache(object):
+    """Outgoing properties kept in a local SQLite file by a key that
+identifies the solver spec and incoming properties, for db_solver.py
+--cache.  Once the stored results take more than max_bytes, the least
+recently used are evicted down to 90% of that.  Only used from the
+coordinator thread.
+
+    """
+    # stay well under the default SQLITE_MAX_VARIABLE_NUMBER
+    max_variables=500
+
+    def __init__(self,path,max_bytes):
+        self.path=os.path.expanduser(path)
+        self.max_bytes=max_bytes
+        # several db_solver.py on this host can share the file
+        self.CONNECTION=sqlite3.connect(self.path,timeout=60.0)
+        self.CONNECTION.execute("PRAGMA journal_mode=WAL;")
+        self.CONNECTION.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, outgoing BLOB, size INTEGER, last_used REAL);")
+        self.CONNECTION.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);")
+        self.total_bytes=self.CONNECTION.execute("SELECT coalesce(sum(size),0) FROM results;").fetchone()[0]
+        self.CONNECTION.commit()
+        self.pending=[]
+
+    def get_many(self,keys):
+        """Look up keys, returns key -> outgoing_properties_dict for
+those found."""
+        keys=list(set(keys))
+        found={}
+        for i in xrange(0,len(keys),self.max_variables):
+            keys_chunk=keys[i:i+self.max_variables]
+            for key,outgoing in self.CONNECTION.execute("SELECT key,outgoing FROM results WHERE key IN (" + ','.join(['?']*len(keys_chunk)) + ");",keys_chunk):
+                found[key]=cPickle.loads(str(outgoing))
+        if found:
+            now=time.time()
+            self.CONNECTION.executemany("UPDATE results SET last_used=? WHERE key=?;",[(now,key) for key in found])
+            self.CONNECTION.commit()
+        return found
+
+    def put(self,key,outgoing_properties_dict):
+        """Queue a result to be stored by the next flush()."""
+        self.pending.append((key,cPickle.dumps(outgoing_properties_dict,cPickle.HIGHEST_PROTOCOL)))
+
+    def flush(self):
+        """Store everything queued by put() and evict if needed."""
+        if self.pending == []:
+            return
+        now=time.time()
+        for key,outgoing in self.pending:
+            CURSOR=self.CONNECTION.execute("INSERT OR IGNORE INTO results (key,outgoing,size,last_used) VALUES (?,?,?,?);",(key,buffer(outgoing),len(outgoing),now))
+            if CURSOR.rowcount > 0:
+                self.total_bytes+=len(outgoing)
+        self.pending=[]
+        if self.total_bytes > self.max_bytes:
+            # well under max_bytes so this is not needed every flush
+            while self.total_bytes > 0.9*self.max_bytes:
+                evicted=self.CONNECTION.execute("SELECT key,size FROM results ORDER BY last_used LIMIT 1000;").fetchall()
+                if evicted == []:
+                    self.total_bytes=0
+                    break
+                self.CONNECTION.executemany("DELETE FROM results WHERE key=?;",[(key,) for key,size in evicted])
+                self.total_bytes-=sum([size for key,size in evicted])
+        self.CONNECTION.commit()
+
+    def close(self):
+        self.flush()
+        self.CONNECTION.close()
+
+################################################################################
+## phase-level metrics
+
+class DbMetrics(object):
+    """Records how long each phase of db_solver.py or db_watcher.py takes
+and how often it happens.  The running totals are appended as a line
+of JSON to path at most every interval seconds, so the last line
+always has the totals so far.
+
+    """
+    def __init__(self,path,interval):
+        self.path=path
+        self.interval=interval
+        # the db_solver.py prefetcher records from its own thread
+        self.lock=threading.Lock()
+        self.phases={}
+        self.counts={}
+        self.start_time=time.time()
+        self.last_dump=self.start_time
+
+    def add(self,phase,duration):
+        """Record one occurence of phase that took duration seconds."""
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase]={'count':0,'total':0.0,'max':0.0}
+            record=self.phases[phase]
+            record['count']+=1
+            record['total']+=duration
+            record['max']=max(record['max'],duration)
+
+    def count(self,name,number=1):
+        with self.lock:
+            self.counts[name]=self.counts.get(name,0)+number
+
+    def phase(self,phase):
+        """Time a phase with a with statement."""
+        return DbMetricsPhase(self,phase)
+
+    def maybe_dump(self):
+        if time.time()-self.last_dump >= self.interval:
+            self.dump()
+
+    def dump(self):
+        with self.lock:
+            now=time.time()
+            record={'time':now,
+                    'elapsed':now-self.start_time,
+                    'host':socket.gethostname(),
+                    'pid':os.getpid(),
+                    'phases':self.phases,
+                    'counts':self.counts}
+            fh=open(self.path,'a')
+            fh.write(json.dumps(record,sort_keys=True) + '\n')
+            fh.close()
+            self.last_dump=now
+
+class DbMetricsPhase(object):
+    def __init__(self,metrics,phase):
+        self.metrics=metrics
+        self.phase=phase
+
+    def __enter__(self):
+        self.start_time=time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        self.metrics.add(self.phase,time.time()-self.start_time)
+        return False
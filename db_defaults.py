@@ -27,31 +27,108 @@
 # configuration options
 # TODO: put in seperate file
 
-__all__= ['MAXUPDATESTRINGS','LIMITPERSEGMENT','CHECKDELAY','HOSTLIST','MAXREDUCTIONS','TYPICAL_CORES','NOMINAL_PARITIONS','WORKWAIT']
+__all__= ['MAXUPDATESTRINGS','LIMITPERSEGMENT','HOSTLIST','TYPICAL_CORES','NOMINAL_PARITIONS','CLAIMSIZE','CHUNKTARGETTIME','DISPATCHAHEAD','EVENTTIMEOUT','SPECULATIVESAMPLES','SPECULATIVEQUANTILE','SPECULATIVEFACTOR','SPECULATIVEMINTIME','SPECULATIVEMAXATTEMPTS','SPECULATIVECHECK','METRICSINTERVAL','AUTOTUNEMEMORYPERPROCESS','AUTOTUNESEGMENTTIME','AUTOTUNECOMMITFRACTION','AUTOTUNESMOOTHING','AUTOTUNEMAXSEGMENT','AUTOTUNEMAXFLUSH','ARRAYCOMPRESSION','SCHEDULERHORIZON','SCHEDULERREFILL','SCHEDULERSAMPLETIME','SCHEDULERSMOOTHING','RESULTCACHEMAXBYTES','WRITERQUEUESIZE','RETRYATTEMPTS','TASKTIMEBUDGETS','TASKBUDGETCHECK','LEASETIME','LEASEHEARTBEAT','COSTMODELSAMPLES','COSTMODELNEIGHBOURS']
 # tuning parameters to reduce load on database
 # TODO: upgrade these to match machines after they are used
 
+# number of results queued before they are written back in bulk, they
+# are journaled under PYMATHDBTMP until committed so this can be large
 MAXUPDATESTRINGS=4096
 LIMITPERSEGMENT=32768
 # MAXUPDATESTRINGS=256
 # LIMITPERSEGMENT=2048
-# check the database every 3 seconds.... originally 10
-CHECKDELAY=2
 # for testing
 # LIMITPERSEGMENT=128
 # TODO: need a master hostlist, farm everything out if more than one hostlist?
 ################################################################################
 # FILL THESE IN, WILL NOT WORK WITHOUT THEM
 HOSTLIST=['akroshko-main','akroshko-server']
-# only reduce amount of work per chunk a certain number of times
-MAXREDUCTIONS=2
 # assign more work when number assigned is less than typical cores, to keep cores full even if some things take a long time
 TYPICAL_CORES=4
 # TODO: upped from 4 for better load balancing
 NOMINAL_PARITIONS=16
 # make hostname specific
 # LIMITPERSEGMENT=2048
-WORKWAIT=2
+# problems claimed at once by db_solver.py --claim, small enough that
+# every host gets a share of a batch
+CLAIMSIZE=max(TYPICAL_CORES,LIMITPERSEGMENT/NOMINAL_PARITIONS)
+# seconds of solving sent to a worker at once when the chunk size is
+# picked automatically
+CHUNKTARGETTIME=0.5
+# chunks per process db_solver.py keeps in its pool, the rest of a
+# segment is held back so db_watcher.py can still move it to an idle
+# host
+DISPATCHAHEAD=2
+# db_solver.py and db_watcher.py wake on LISTEN/NOTIFY events, this is
+# only how long to wait before checking anyways in case one is missed
+EVENTTIMEOUT=60
+# db_solver.py --speculative, a problem running longer than
+# SPECULATIVEFACTOR times the SPECULATIVEQUANTILE of the last
+# SPECULATIVESAMPLES worker times (and at least SPECULATIVEMINTIME
+# seconds) is dispatched again, at most SPECULATIVEMAXATTEMPTS times
+# in total, checking every SPECULATIVECHECK seconds
+SPECULATIVESAMPLES=1024
+SPECULATIVEQUANTILE=0.95
+SPECULATIVEFACTOR=3.0
+SPECULATIVEMINTIME=1.0
+SPECULATIVEMAXATTEMPTS=2
+SPECULATIVECHECK=1.0
+# seconds between writing phase metrics to metrics.jsonl in the log
+# directory
+METRICSINTERVAL=30
+# db_solver.py --auto-tune, one process per core as long as each has
+# AUTOTUNEMEMORYPERPROCESS bytes of memory, segments hold about
+# AUTOTUNESEGMENTTIME seconds of work for the whole pool and results
+# are flushed often enough that writing them back and committing
+# takes about AUTOTUNECOMMITFRACTION of the time, commit latency is
+# smoothed by AUTOTUNESMOOTHING and sizes are capped at
+# AUTOTUNEMAXSEGMENT and AUTOTUNEMAXFLUSH
+AUTOTUNEMEMORYPERPROCESS=512*1024**2
+AUTOTUNESEGMENTTIME=60.0
+AUTOTUNECOMMITFRACTION=0.05
+AUTOTUNESMOOTHING=0.2
+AUTOTUNEMAXSEGMENT=8*LIMITPERSEGMENT
+AUTOTUNEMAXFLUSH=8*MAXUPDATESTRINGS
+# zlib level for NumPy arrays written to bytea columns, 0 stores the
+# raw buffer, worthwhile for smooth trajectories but rarely for noise
+ARRAYCOMPRESSION=0
+# db_watcher.py gives each host about SCHEDULERHORIZON seconds of work
+# at its measured rate (less near the end of a batch so all hosts finish
+# together), topping up once it has less than SCHEDULERREFILL of that
+# left, rates are sampled at most every SCHEDULERSAMPLETIME seconds
+# and smoothed by SCHEDULERSMOOTHING
+SCHEDULERHORIZON=600.0
+SCHEDULERREFILL=0.5
+SCHEDULERSAMPLETIME=10.0
+SCHEDULERSMOOTHING=0.3
+# db_solver.py --cache evicts the least recently used results once they
+# take more than this many bytes
+RESULTCACHEMAXBYTES=4*1024**3
+# flushes of results waiting for the db_solver.py writer thread before
+# the main loop waits for it
+WRITERQUEUESIZE=4
+# a problem whose solver raises is dispatched up to RETRYATTEMPTS times
+# in total, then settled as done with the error and number of attempts
+# in the error and attempts columns of the batch table
+RETRYATTEMPTS=2
+# seconds a single problem may run before its worker is killed and it is
+# settled as timed out, by the name of the solver object (without the
+# '<<' '>>') or otherwise the batch table, e.g.,
+# TASKTIMEBUDGETS={'ReferenceSolver':3600.0,'some_batch_table':60.0}
+TASKTIMEBUDGETS={}
+# how often budgets are checked
+TASKBUDGETCHECK=1.0
+# work assigned to a host is leased for LEASETIME seconds, db_solver.py
+# renews the lease of its host every LEASEHEARTBEAT seconds and work
+# whose lease expires (e.g., the host crashed) goes back to being
+# unassigned
+LEASETIME=300
+LEASEHEARTBEAT=60
+# db_solver.py --longest-first predicts worker times from the
+# COSTMODELNEIGHBOURS nearest of the last COSTMODELSAMPLES problems
+# solved with the same spec
+COSTMODELSAMPLES=1024
+COSTMODELNEIGHBOURS=8
 # memory is big so this is fine
 # should have table I read to get...
 # hostname (whether work is assigned to me)
@@ -35,8 +35,18 @@ sys.path.append(sys.argv[1])
 pymath_default_imports(globals(),locals())
 exec('from ' + sys.argv[2] + ' import *')
 
+import collections
+import cPickle
+import errno
+import hashlib
+import multiprocessing.util
 import Queue
+import re
+import signal
+import threading
+import types
 
+from db_common import *
 from db_defaults import *
 try:
     from db_defaults_local import *
@@ -49,8 +59,21 @@ except ImportError:
 TMPPATH=os.getenv('PYMATHDBTMP')
 
 # TODO: add a --curent-host-only option
+# --claim pulls work for this host directly from the batch table so
+# db_watcher.py is not needed
+# --speculative re-dispatches stragglers when cores are idle at the
+# end of a batch, whichever copy finishes first is kept
+# --auto-tune sizes the pool from the cores and memory of this host and
+# adjusts segment, flush and claim sizes from measured solve times and
+# commit latency
 if '--serial' in sys.argv:
     PROCESSES=1
+elif '--auto-tune' in sys.argv:
+    HOST_CORES,HOST_MEMORY=db_host_capacity()
+    if HOST_MEMORY is None:
+        PROCESSES=HOST_CORES
+    else:
+        PROCESSES=max(1,min(HOST_CORES,HOST_MEMORY/AUTOTUNEMEMORYPERPROCESS))
 else:
     # XXXX: change this to match the cores per CPU
     PROCESSES=4
@@ -58,6 +81,12 @@ MAXTASKSPERCHILD=512
 
 THEHOSTNAME=socket.gethostname()
 
+# --sqlite=path uses an embedded SQLite database rather than PostgreSQL
+BACKEND=db_backend(ARRAYCOMPRESSION)
+# hostname designations only matter if other processes or hosts could
+# be working on the same batch table
+IGNORE_HOSTNAME=('--serial' in sys.argv or not BACKEND.shared)
+
 # XXXX: set this extremely large, if there are wierd problems, delete
 #       this line
 sys.setcheckinterval(10000)
@@ -76,269 +105,1411 @@ if __name__ == '__main__':
         SPECIFIC_LOGDIR=os.path.join(LOGDIR,'db_solver_'+timestamp_now()+'_'+sys.argv[3])
         if not os.path.exists(SPECIFIC_LOGDIR):
             os_makedirs(SPECIFIC_LOGDIR)
+        METRICS=DbMetrics(os.path.join(SPECIFIC_LOGDIR,'metrics.jsonl'),METRICSINTERVAL)
     else:
         # TODO: add a help message and exit
         sys.exit(1)
 
-def db_solver_worker(q,solve_number,selected_solver,incoming_properties_dict,redirect_stdout_path=None):
-    """A worker that runs the solver with a particular set of
-parameters.
+# solver specs interned by the coordinator, spec_id -> spec
+SPEC_REGISTRY={}
+# specs resolved and validated in this worker process, spec_id -> resolved spec
+WORKER_SPECS={}
+
+def db_spec_path(spec_id):
+    """Where the coordinator publishes a spec for the workers."""
+    return os.path.join(SPECIFIC_LOGDIR,'specs',spec_id+'.pickle')
+
+def db_intern_spec(dbtable,selected_solver):
+    """Intern a solver spec so that the many problems in a dbtable that
+share it also share one spec_id.  The first time a spec is seen it is
+published under SPECIFIC_LOGDIR so workers can load it by spec_id.
+
+    **Returns**
+      string:
+        The spec_id, from the dbtable and a hash of the spec.
 
     """
-    # DBSOLVERTIMESTAMP should clear out as soon as things are reset
-    # TODO: do not check verbose flag every time
-    worker_time=TIME_TIME()
-    verbose_flag='--verbose' in sys.argv
-    if redirect_stdout_path:
-        stdout_old=sys.stdout
-        if verbose_flag:
-            # I like to remove buffering during verbose so i can catch
-            # the last possible output if something locks up this is
-            # especially useful when viewing over SSH
-            fh=open(os.path.join(redirect_stdout_path,str(os.getpid())+'.out'),"a", buffering=0)
-        else:
-            # do not put anything to stdout during production runs
-            fh=open(os.devnull,"a")
-        sys.stdout = fh
-    try:
+    spec=tuple([selected_solver[0],selected_solver[1],selected_solver[2],tuple(selected_solver[3]),tuple(selected_solver[4])])
+    spec_id=dbtable + '_' + hashlib.sha1(repr(spec)).hexdigest()[:16]
+    if spec_id not in SPEC_REGISTRY:
+        spec_path=db_spec_path(spec_id)
+        os_makedirs(os.path.dirname(spec_path))
+        # rename so a worker never sees a partially written spec
+        fh=open(spec_path+'.tmp','wb')
+        cPickle.dump(spec,fh,cPickle.HIGHEST_PROTOCOL)
+        fh.close()
+        os.rename(spec_path+'.tmp',spec_path)
+        SPEC_REGISTRY[spec_id]=spec
+    return spec_id
+
+def db_resolve_spec(spec_id):
+    """Resolve the '<<name>>' placeholders of a spec to the solver
+objects and properties in globals(), once per worker process."""
+    if spec_id not in WORKER_SPECS:
+        fh=open(db_spec_path(spec_id),'rb')
+        spec=cPickle.load(fh)
+        fh.close()
         # placeholders in strings that reference solver objects are
         # surrounded by '<<' '>>'
-        if not selected_solver[0][0].startswith('<<') or not selected_solver[0][0].endswith('>>'):
+        if not spec[0].startswith('<<') or not spec[0].endswith('>>'):
             raise RuntimeError("solver_object string not valid!!!")
-        if not selected_solver[0][1].startswith('<<') or not selected_solver[0][1].endswith('>>'):
+        if not spec[1].startswith('<<') or not spec[1].endswith('>>'):
             raise RuntimeError("method_properties string not valid!!!")
-        if not selected_solver[0][2].startswith('<<') or not selected_solver[0][2].endswith('>>'):
+        if not spec[2].startswith('<<') or not spec[2].endswith('>>'):
             raise RuntimeError("ode_properties string not valid!!!")
-        solver_object              = globals()[selected_solver[0][0].strip('<>')]
-        method_properties          = globals()[selected_solver[0][1].strip('<>')]
-        ode_properties             = globals()[selected_solver[0][2].strip('<>')]
-        incoming_properties_keys   = selected_solver[0][3]
-        outgoing_properties_keys   = selected_solver[0][4]
-        if verbose_flag:
-            print("--------------------")
-            pprint(ode_properties)
-            pprint(method_properties)
-            pprint(incoming_properties_dict)
-        outgoing_properties = solver_object(method_default_properties=method_properties,
-                                            ode_default_properties=ode_properties,
-                                            incoming_properties=incoming_properties_dict).run(globals())
-        new_dict={}
-        for k in outgoing_properties_keys:
-            if outgoing_properties.has_key(k):
-                new_dict[k]=outgoing_properties[k]
-            else:
-                new_dict[k]=None
-        outgoing_properties_dict=new_dict
-        # TODO: add more error checking to make sure nothing invalid goes into the queue
-        if verbose_flag:
-            pprint(outgoing_properties_dict)
-        # put outgoing_properties_dict into the queue, block until there is space
-        # TODO: wish I was not blocking here, or I at least knew the amount of time spent blocking
-        outgoing_properties_dict['worker time']=TIME_TIME()-worker_time
-        q.put((solve_number,outgoing_properties_dict),block=True)
-    except Exception,e:
-        # print out all relevant information if an exception occurs
-        # TODO: option to send exception data to stderr and/or log
-        # TODO: send back data that kills running solvers
-        print(str(e))
-        # TODO: make sure this goes to stderr
-        traceback.print_exc()
+        WORKER_SPECS[spec_id]=(globals()[spec[0].strip('<>')],
+                               globals()[spec[1].strip('<>')],
+                               globals()[spec[2].strip('<>')],
+                               spec[3],
+                               spec[4])
+    return WORKER_SPECS[spec_id]
+
+# for --cache, spec_id -> db_stable_repr of the resolved spec, or None
+# if it cannot be resolved in the coordinator
+CACHE_SPECS={}
+
+def db_stable_repr(value):
+    """A repr of value that does not depend on dictionary order or the
+process, for hashing.  Solver objects and functions are identified by
+module and name, arrays by dtype, shape and a hash of their data."""
+    if isinstance(value,dict):
+        return '{' + ','.join([db_stable_repr(k) + ':' + db_stable_repr(value[k]) for k in sorted(value.keys())]) + '}'
+    elif isinstance(value,(list,tuple)):
+        return '[' + ','.join([db_stable_repr(v) for v in value]) + ']'
+    elif isinstance(value,np.ndarray):
+        return 'ndarray(' + value.dtype.str + ',' + repr(value.shape) + ',' + hashlib.sha1(np.ascontiguousarray(value).tostring()).hexdigest() + ')'
+    elif isinstance(value,(type,types.ClassType,types.FunctionType,types.BuiltinFunctionType)):
+        return getattr(value,'__module__','') + '.' + value.__name__
+    else:
+        # anything with the default repr includes its address and so
+        # never hits the cache, which is safe
+        return repr(value)
+
+def db_cache_key(spec_id,incoming_properties_dict):
+    """The --cache key of a problem, a hash of its resolved solver spec
+and incoming properties, or None if the spec cannot be resolved."""
+    if spec_id not in CACHE_SPECS:
+        try:
+            CACHE_SPECS[spec_id]=db_stable_repr(db_resolve_spec(spec_id))
+        except Exception:
+            # the worker reports the problem
+            CACHE_SPECS[spec_id]=None
+    if CACHE_SPECS[spec_id] is None:
+        return None
+    return hashlib.sha1(CACHE_SPECS[spec_id] + db_stable_repr(incoming_properties_dict)).hexdigest()
+
+# set once per worker process by db_solver_worker_init
+WORKER_VERBOSE=False
+WORKER_LOG=None
+WORKER_SLOTS=None
+WORKER_SLOT=None
+
+def db_solver_worker_init(redirect_stdout_path,verbose_flag,task_slots=None):
+    """Initializer for the pool, sets up each worker process once rather
+than for every chunk.
+
+    **Parameters**
+      redirect_stdout_path:
+        Where each worker keeps its <pid>.out log with --verbose, or
+        None to leave stdout alone (e.g., with --serial).
+      verbose_flag:
+        Whether --verbose was given.
+      task_slots:
+        A multiprocessing.Array of what each worker is running for
+        DbTaskWatchdog, or None if there are no time budgets.
+
+    """
+    global WORKER_VERBOSE
+    global WORKER_LOG
+    global WORKER_SLOTS
+    global WORKER_SLOT
+    WORKER_VERBOSE=verbose_flag
+    WORKER_SLOTS=task_slots
+    if task_slots is not None:
+        WORKER_SLOT=db_claim_worker_slot(task_slots)
     if redirect_stdout_path:
         if verbose_flag:
-            sys.stdout.flush()
-        sys.stdout.close()
-        sys.stdout=stdout_old
+            # line buffered so the last output is still there if
+            # something locks up, this is especially useful when
+            # viewing over SSH
+            WORKER_LOG=open(os.path.join(redirect_stdout_path,str(os.getpid())+'.out'),"a",buffering=1)
+        else:
+            # do not put anything to stdout during production runs
+            WORKER_LOG=open(os.devnull,"a")
+        sys.stdout=WORKER_LOG
+        # runs when the worker exits, including after MAXTASKSPERCHILD
+        multiprocessing.util.Finalize(None,db_solver_worker_close_log,exitpriority=10)
+
+def db_solver_worker_close_log():
+    """Close the log of a worker as it exits.  stdout is put back first
+since the pool flushes sys.stdout after the worker returns."""
+    WORKER_LOG.flush()
+    sys.stdout=sys.__stdout__
+    WORKER_LOG.close()
+
+def db_claim_worker_slot(task_slots):
+    """The index of a free slot in task_slots for this worker, either
+never used or left by a worker that exited or was killed.
+
+    Each slot is (pid,chunk_id,solve_number,start time), chunk_id is -1
+    while the worker is not running a problem.
+
+    """
+    with task_slots.get_lock():
+        for slot in xrange(len(task_slots)/4):
+            pid=int(task_slots[4*slot])
+            if pid == 0 or not db_pid_alive(pid):
+                task_slots[4*slot:4*slot+4]=[os.getpid(),-1,-1,0.0]
+                return slot
+    raise RuntimeError("No free worker slot!!!")
+
+def db_set_worker_slot(chunk_id,solve_number,start_time):
+    """Record in this worker's slot the problem it is running."""
+    with WORKER_SLOTS.get_lock():
+        WORKER_SLOTS[4*WORKER_SLOT+1:4*WORKER_SLOT+4]=[chunk_id,solve_number,start_time]
+
+def db_solver_worker(tasks,chunk_id=-1):
+    """A worker that runs the solver for a chunk of problems, each with
+a particular set of parameters.
+
+    **Parameters**
+      tasks:
+        A list of (solve_number,spec_id,incoming_properties_dict).
+      chunk_id:
+        The id DbTaskWatchdog gave this dispatch of the chunk.
+
+    **Returns**
+      str:
+        A pickled list, of a (solve_number,outgoing_properties_dict,None)
+        for each task, or (solve_number,None,error) for a task where the
+        solver raised an exception or the result could not be pickled,
+        error being the traceback.
+
+    """
+    # DBSOLVERTIMESTAMP should clear out as soon as things are reset
+    # stdout was already set up by db_solver_worker_init
+    verbose_flag=WORKER_VERBOSE
+    outgoing_list=[]
+    for solve_number,spec_id,incoming_properties_dict in tasks:
+        worker_time=TIME_TIME()
+        if WORKER_SLOTS is not None:
+            db_set_worker_slot(chunk_id,solve_number,worker_time)
+        try:
+            solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys=db_resolve_spec(spec_id)
+            if verbose_flag:
+                print("--------------------")
+                pprint(ode_properties)
+                pprint(method_properties)
+                pprint(incoming_properties_dict)
+            outgoing_properties = solver_object(method_default_properties=method_properties,
+                                                ode_default_properties=ode_properties,
+                                                incoming_properties=incoming_properties_dict).run(globals())
+            new_dict={}
+            for k in outgoing_properties_keys:
+                if outgoing_properties.has_key(k):
+                    new_dict[k]=outgoing_properties[k]
+                else:
+                    new_dict[k]=None
+            outgoing_properties_dict=new_dict
+            # TODO: add more error checking to make sure nothing invalid is returned
+            if verbose_flag:
+                pprint(outgoing_properties_dict)
+            outgoing_properties_dict['worker time']=TIME_TIME()-worker_time
+            outgoing=(solve_number,outgoing_properties_dict,None)
+        except Exception,e:
+            # print out all relevant information if an exception occurs
+            # TODO: send back data that kills running solvers
+            print(str(e))
+            # TODO: make sure this goes to stderr
+            traceback.print_exc()
+            # the coordinator retries or records the error
+            outgoing=(solve_number,None,traceback.format_exc())
+        if WORKER_SLOTS is not None:
+            # the watchdog only kills a worker while holding the lock
+            # and seeing it run a problem, so it is safe once cleared
+            db_set_worker_slot(-1,-1,0.0)
+        outgoing_list.append(outgoing)
+    # pickled here rather than by the pool, which never calls back for
+    # a chunk that cannot be pickled and the coordinator would wait
+    # forever, this way it is still only pickled once
+    try:
+        return cPickle.dumps(outgoing_list,cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        traceback.print_exc()
+    # find the results at fault
+    for i,(solve_number,outgoing_properties_dict,error) in enumerate(outgoing_list):
+        try:
+            cPickle.dumps(outgoing_properties_dict,cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            outgoing_list[i]=(solve_number,None,traceback.format_exc())
+    return cPickle.dumps(outgoing_list,cPickle.HIGHEST_PROTOCOL)
+
+def db_chunk_size(number_of_tasks,worker_time_total,worker_time_count):
+    """Number of problems sent to a worker at once.
+
+    Set with --chunksize=N, otherwise picked so a chunk takes about
+    CHUNKTARGETTIME seconds of observed worker time, but never so large
+    that some processes are left without a chunk.
+
+    """
+    chunksize=db_argv_value('--chunksize')
+    if chunksize is not None:
+        return max(1,int(chunksize))
+    # one at a time until there is some idea how long a solve takes
+    if worker_time_count < PROCESSES:
+        return 1
+    worker_time_mean=worker_time_total/worker_time_count
+    chunksize=int(CHUNKTARGETTIME/max(worker_time_mean,1.0e-6))
+    # leave a few chunks per process for load balancing
+    chunksize=min(chunksize,number_of_tasks/(PROCESSES*4))
+    return max(1,chunksize)
+
+class DbCostModel(object):
+    """Predicts the worker time of problems from those already solved
+with the same spec, for --longest-first.
+
+    A prediction is the mean worker time of the COSTMODELNEIGHBOURS
+    nearest of the last COSTMODELSAMPLES problems solved with the same
+    spec_id, by distance between numeric incoming properties scaled by
+    their standard deviation.  Problems already solved in a dbtable are
+    loaded the first time it is seen, others are added as they finish.
+
+    """
+    def __init__(self):
+        # seeded from the prefetch thread, added to from the main loop
+        self.lock=threading.Lock()
+        # spec_id -> numeric incoming keys, and -> deque of (features,worker time)
+        self.feature_keys={}
+        self.samples={}
+        # spec_id -> (scale,scaled features,worker times) for predict()
+        self.arrays={}
+        self.seeded=set()
+
+    def add(self,spec_id,incoming_properties_dict,worker_time):
+        with self.lock:
+            if spec_id not in self.samples:
+                self.feature_keys[spec_id]=[k for k in sorted(incoming_properties_dict.keys())
+                                            if isinstance(incoming_properties_dict[k],(int,long,float,np.number))]
+                self.samples[spec_id]=collections.deque(maxlen=COSTMODELSAMPLES)
+            features=self._features(spec_id,incoming_properties_dict)
+            if features is not None:
+                self.samples[spec_id].append((features,worker_time))
+                self.arrays.pop(spec_id,None)
+
+    def seed(self,CURSOR,dbtables):
+        """Add problems already solved in any of dbtables not seen before."""
+        for dbtable in dbtables:
+            if dbtable in self.seeded:
+                continue
+            self.seeded.add(dbtable)
+            solved_rows=BACKEND.select_solved(CURSOR,dbtable,SPEC_COLUMNS + ['worker time'],COSTMODELSAMPLES)
+            worker_times=dict([(row[0],row[6]) for row in solved_rows])
+            for solve_number,(spec_id,incoming_properties_dict) in db_load_incoming(CURSOR,dbtable,[row[:6] for row in solved_rows]).iteritems():
+                self.add(spec_id,incoming_properties_dict,worker_times[solve_number])
+
+    def predict(self,tasks):
+        """Predicted worker times for (solve_number,spec_id,incoming_properties_dict)
+tasks, None where nothing with the same spec has been solved."""
+        predictions=[None]*len(tasks)
+        indices_by_spec={}
+        for i,task in enumerate(tasks):
+            indices_by_spec.setdefault(task[1],[]).append(i)
+        for spec_id,indices in indices_by_spec.iteritems():
+            with self.lock:
+                arrays=self._arrays(spec_id)
+            if arrays is None:
+                continue
+            scale,scaled_features,worker_times=arrays
+            mean_worker_time=worker_times.mean()
+            features=[self._features(spec_id,tasks[i][2]) for i in indices]
+            known=[j for j in xrange(len(indices)) if features[j] is not None]
+            for j in xrange(len(indices)):
+                predictions[indices[j]]=mean_worker_time
+            if scaled_features.shape[1] == 0 or len(worker_times) <= COSTMODELNEIGHBOURS or known == []:
+                continue
+            x=np.array([features[j] for j in known])/scale
+            # in blocks to bound the size of the distance matrix
+            for k in xrange(0,len(known),1024):
+                distances=((x[k:k+1024,np.newaxis,:]-scaled_features[np.newaxis,:,:])**2).sum(axis=2)
+                nearest=np.argpartition(distances,COSTMODELNEIGHBOURS-1,axis=1)[:,:COSTMODELNEIGHBOURS]
+                for j,prediction in zip(known[k:k+1024],worker_times[nearest].mean(axis=1)):
+                    predictions[indices[j]]=prediction
+        return predictions
+
+    def _features(self,spec_id,incoming_properties_dict):
+        try:
+            return [float(incoming_properties_dict[k]) for k in self.feature_keys[spec_id]]
+        except (KeyError,TypeError,ValueError):
+            return None
+
+    def _arrays(self,spec_id):
+        if spec_id not in self.samples or len(self.samples[spec_id]) == 0:
+            return None
+        if spec_id not in self.arrays:
+            features=np.array([sample[0] for sample in self.samples[spec_id]],dtype=float).reshape(len(self.samples[spec_id]),len(self.feature_keys[spec_id]))
+            scale=features.std(axis=0)
+            scale[scale == 0.0]=1.0
+            self.arrays[spec_id]=(scale,features/scale,np.array([sample[1] for sample in self.samples[spec_id]],dtype=float))
+        return self.arrays[spec_id]
+
+# set by main() with --longest-first
+COST_MODEL=None
+
+def db_longest_first(tasks,chunksize):
+    """Order tasks longest expected first and chunk them, so the long
+problems do not end up in the tail of the batch.  Chunks are filled to
+about CHUNKTARGETTIME seconds of expected worker time, at most chunksize
+problems, so expensive problems go out on their own.
+
+    **Returns**
+      list:
+        The chunks of tasks in the order to dispatch them.
+
+    """
+    predictions=COST_MODEL.predict(tasks)
+    known=[prediction for prediction in predictions if prediction is not None]
+    if known == []:
+        return [tasks[i:i+chunksize] for i in xrange(0,len(tasks),chunksize)]
+    # anything without a prediction is taken to be typical
+    typical=sum(known)/len(known)
+    predictions=[typical if prediction is None else prediction for prediction in predictions]
+    order=sorted(xrange(len(tasks)),key=lambda i: predictions[i],reverse=True)
+    if db_argv_value('--chunksize') is not None:
+        return [[tasks[i] for i in order[j:j+chunksize]] for j in xrange(0,len(order),chunksize)]
+    chunks=[]
+    chunk=[]
+    chunk_time=0.0
+    for i in order:
+        chunk.append(tasks[i])
+        chunk_time+=predictions[i]
+        if chunk_time >= CHUNKTARGETTIME or len(chunk) >= chunksize:
+            chunks.append(chunk)
+            chunk=[]
+            chunk_time=0.0
+    if chunk != []:
+        chunks.append(chunk)
+    return chunks
+
+class DbResultCollector(object):
+    """Collects results from db_solver_worker through the pool's own
+result channel.
+
+    The apply_async callback runs on the pool's result handler thread
+    and hands each result to a local queue, so the coordinator blocks
+    until a result actually arrives rather than polling a manager
+    proxy.
+
+    """
+    def __init__(self):
+        self.results=Queue.Queue()
+
+    def callback(self,outgoing_pickle):
+        # db_solver_worker pickles its own results
+        for outgoing in cPickle.loads(outgoing_pickle):
+            self.results.put(outgoing)
+
+    def get(self,timeout=None):
+        # XXXX: only use a timeout when needed, in Python 2 a timeout
+        #       turns this into a sleep and poll loop
+        return self.results.get(timeout=timeout)
+
+class DbInFlightRegistry(object):
+    """The problems dispatched to the pool that have not come back yet,
+by solve_number, and the chunks held back to dispatch later.
+
+    Each entry records the task, when it was first and last dispatched,
+    the host, how many times it has been dispatched and how many of
+    those failed.  Problems can be dispatched more than once when
+    speculative re-execution is on or a failure is retried, the first
+    result to come back is the one that counts.  Held problems are in
+    flight too, but have not been dispatched at all.
+
+    """
+    def __init__(self):
+        self.tasks={}
+        self.held=collections.deque()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self,solve_number):
+        return solve_number in self.tasks
+
+    def keys(self):
+        return self.tasks.keys()
+
+    def copies(self):
+        """Number of copies of in flight problems dispatched."""
+        return sum([record['attempts'] for record in self.tasks.itervalues()])
+
+    def hold(self,chunk):
+        """Keep a chunk to dispatch later."""
+        for task in chunk:
+            self.tasks[task[0]]={'task':task,
+                                 'dispatch time':None,
+                                 'last dispatch time':None,
+                                 'host':THEHOSTNAME,
+                                 'attempts':0,
+                                 'failures':0}
+        self.held.append(chunk)
+
+    def dispatched(self,chunk):
+        """Record that a held chunk was dispatched."""
+        now=TIME_TIME()
+        for task in chunk:
+            record=self.tasks[task[0]]
+            record['dispatch time']=now
+            record['last dispatch time']=now
+            record['attempts']=1
+
+    def redispatch(self,solve_number):
+        record=self.tasks[solve_number]
+        record['last dispatch time']=TIME_TIME()
+        record['attempts']+=1
+        return record['task']
+
+    def complete(self,solve_number):
+        """Remove a problem whose result has arrived.
+
+        **Returns**
+          dict:
+            The record of the problem, or None if it is not in flight,
+            i.e., this result is from a slower copy of a problem that
+            has already finished.
+
+        """
+        return self.tasks.pop(solve_number,None)
+
+    def fail(self,solve_number):
+        """Record that one copy of a problem failed.
+
+        **Returns**
+          dict:
+            The record of the problem, or None if it is not in flight
+            because another copy already finished.
+
+        """
+        record=self.tasks.get(solve_number)
+        if record is not None:
+            record['failures']+=1
+        return record
+
+    def requeue(self,solve_number):
+        """The task of a problem whose copy was lost with its worker, to
+be dispatched again without counting as another attempt."""
+        record=self.tasks[solve_number]
+        record['last dispatch time']=TIME_TIME()
+        return record['task']
+
+    def stragglers(self,threshold,max_attempts):
+        """Problems whose latest dispatch has been running more than
+threshold seconds and that can be dispatched again."""
+        now=TIME_TIME()
+        return [solve_number for solve_number,record in self.tasks.iteritems()
+                if 0 < record['attempts'] < max_attempts and now-record['last dispatch time'] > threshold]
+
+def db_straggler_threshold(worker_times):
+    """How long a problem runs before it is considered a straggler,
+from the observed distribution of worker time."""
+    if len(worker_times) < PROCESSES:
+        return None
+    sorted_worker_times=sorted(worker_times)
+    quantile=sorted_worker_times[min(len(sorted_worker_times)-1,int(SPECULATIVEQUANTILE*len(sorted_worker_times)))]
+    return max(SPECULATIVEMINTIME,SPECULATIVEFACTOR*quantile)
+
+class DbTaskTimeout(object):
+    """In place of an error from the collector, the problem ran past its
+time budget and its worker was killed."""
+    def __init__(self,elapsed):
+        self.elapsed=elapsed
+
+class DbTaskLost(object):
+    """In place of an error from the collector, the problem was in the
+same chunk as one that timed out, so its result went with the worker."""
+    pass
+
+def db_task_budget(batch_table,spec_id):
+    """The time budget in seconds from TASKTIMEBUDGETS for a problem,
+by the name of its solver object and otherwise its batch table, or None
+for no budget."""
+    solver_name=SPEC_REGISTRY[spec_id][0].strip('<>')
+    if solver_name in TASKTIMEBUDGETS:
+        return TASKTIMEBUDGETS[solver_name]
+    return TASKTIMEBUDGETS.get(batch_table)
+
+class DbTaskWatchdog(object):
+    """Kills workers that run a problem past its time budget.
+
+    Each worker records the chunk and problem it is running in its slot
+    of task_slots.  Once a problem is past its budget its worker is
+    killed and the pool starts a replacement.  The collector then gets a
+    DbTaskTimeout for the problem and a DbTaskLost for everything else
+    in its chunk, since results only come back a whole chunk at a time.
+
+    Chunks are tracked by an id for each dispatch, so copies of a
+    problem dispatched again are told apart.  A worker is only killed
+    while the lock on task_slots is held and its slot shows the problem,
+    a worker that finished is blocked on the pool's queue and killing it
+    would leave the pool's lock held.
+
+    """
+    def __init__(self,batch_table,task_slots,collector):
+        self.batch_table=batch_table
+        self.task_slots=task_slots
+        self.collector=collector
+        # chunk_id -> (solve_numbers in the chunk,solve_number -> budget)
+        self.chunks={}
+        self.next_chunk_id=0
+        self.number_killed=0
+        self.thread=threading.Thread(target=self._run)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def add_chunk(self,tasks):
+        """Returns the id for this dispatch of the chunk."""
+        chunk_id=self.next_chunk_id
+        self.next_chunk_id+=1
+        budgets={}
+        for solve_number,spec_id,incoming_properties_dict in tasks:
+            budget=db_task_budget(self.batch_table,spec_id)
+            if budget is not None:
+                budgets[solve_number]=budget
+        if budgets:
+            self.chunks[chunk_id]=([task[0] for task in tasks],budgets)
+        return chunk_id
+
+    def finish_chunk(self,chunk_id):
+        """The results of the chunk came back."""
+        self.chunks.pop(chunk_id,None)
+
+    def _run(self):
+        while True:
+            time.sleep(TASKBUDGETCHECK)
+            now=TIME_TIME()
+            with self.task_slots.get_lock():
+                for slot in xrange(len(self.task_slots)/4):
+                    pid,chunk_id,solve_number,start_time=self.task_slots[4*slot:4*slot+4]
+                    pid,chunk_id,solve_number=int(pid),int(chunk_id),int(solve_number)
+                    if pid == 0 or chunk_id < 0 or chunk_id not in self.chunks:
+                        continue
+                    chunk,budgets=self.chunks[chunk_id]
+                    budget=budgets.get(solve_number)
+                    if budget is None or now-start_time <= budget:
+                        continue
+                    try:
+                        os.kill(pid,signal.SIGKILL)
+                    except OSError:
+                        # already gone
+                        pass
+                    self.task_slots[4*slot:4*slot+4]=[0,-1,-1,0.0]
+                    self.number_killed+=1
+                    del self.chunks[chunk_id]
+                    self.collector.results.put((solve_number,None,DbTaskTimeout(now-start_time)))
+                    for lost_solve_number in chunk:
+                        if lost_solve_number != solve_number:
+                            self.collector.results.put((lost_solve_number,None,DbTaskLost()))
+
+# set by main() if there are time budgets
+WATCHDOG=None
+
+def db_dispatch(tasks,collector):
+    """Send a chunk of tasks to the pool."""
+    if WATCHDOG is None:
+        POOL.apply_async(db_solver_worker,(tasks,),callback=collector.callback)
+        return
+    chunk_id=WATCHDOG.add_chunk(tasks)
+    def callback(outgoing_pickle):
+        WATCHDOG.finish_chunk(chunk_id)
+        collector.callback(outgoing_pickle)
+    POOL.apply_async(db_solver_worker,(tasks,chunk_id),callback=callback)
 
-def db_more_work(batch_table,CURSOR):
+def db_dispatch_held(CONNECTION,CURSOR,batch_table,in_flight,collector,dispatch_limit,chunksize):
+    """Dispatch chunks held in in_flight once fewer than dispatch_limit
+dispatched problems are left, up to dispatch_limit plus a chunk for each
+process so the database is checked once for several chunks.  Problems
+that db_watcher.py moved to another host since they were selected are
+dropped rather than solved twice.
+
+    **Returns**
+      list:
+        The solve_numbers dropped, they are no longer in in_flight.
+
+    """
+    if len(in_flight.held) == 0 or in_flight.copies() >= dispatch_limit:
+        return []
+    chunks=[]
+    number_released=in_flight.copies()
+    while len(in_flight.held) > 0 and number_released < dispatch_limit+PROCESSES*chunksize:
+        chunks.append(in_flight.held.popleft())
+        number_released+=len(chunks[-1])
+    if IGNORE_HOSTNAME:
+        assigned=None
+    else:
+        with METRICS.phase('assignment check'):
+            assigned=BACKEND.select_assigned(CURSOR,batch_table,THEHOSTNAME,[task[0] for chunk in chunks for task in chunk])
+            CONNECTION.commit()
+    dropped=[]
+    with METRICS.phase('dispatch'):
+        for chunk in chunks:
+            if assigned is not None:
+                dropped.extend([task[0] for task in chunk if task[0] not in assigned])
+                chunk=[task for task in chunk if task[0] in assigned]
+            if chunk != []:
+                in_flight.dispatched(chunk)
+                db_dispatch(chunk,collector)
+    for solve_number in dropped:
+        in_flight.complete(solve_number)
+    return dropped
+
+class DbAutoTuner(object):
+    """Segment, flush and claim sizes for this host.
+
+    Without --auto-tune these are just LIMITPERSEGMENT, MAXUPDATESTRINGS
+    and CLAIMSIZE.  With --auto-tune they follow the rate results come
+    back at, from the mean worker time and PROCESSES, and the smoothed
+    time taken to write back and commit a flush.  Flushes happen on the
+    prefetch thread too, plain assignments are enough to share the sizes.
+
+    """
+    def __init__(self,enabled):
+        self.enabled=enabled
+        self.segment_limit=LIMITPERSEGMENT
+        self.flush_size=MAXUPDATESTRINGS
+        self.claim_size=CLAIMSIZE
+        if enabled:
+            self.claim_size=max(PROCESSES,LIMITPERSEGMENT/NOMINAL_PARITIONS)
+        self.result_rate=None
+        self.flush_time=None
+
+    def record_solves(self,worker_time_total,worker_time_count):
+        """Update from the worker times of everything solved so far."""
+        if not self.enabled or worker_time_count < PROCESSES:
+            return
+        self.result_rate=PROCESSES*worker_time_count/max(worker_time_total,1e-6)
+        self._update()
+
+    def record_flush(self,flush_time):
+        """Update from the time taken to write back and commit a flush."""
+        if not self.enabled:
+            return
+        if self.flush_time is None:
+            self.flush_time=flush_time
+        else:
+            self.flush_time=(1.0-AUTOTUNESMOOTHING)*self.flush_time+AUTOTUNESMOOTHING*flush_time
+        self._update()
+
+    def _update(self):
+        if self.result_rate is None:
+            return
+        # enough work to keep the pool busy AUTOTUNESEGMENTTIME seconds
+        self.segment_limit=int(min(max(self.result_rate*AUTOTUNESEGMENTTIME,4*PROCESSES),AUTOTUNEMAXSEGMENT))
+        self.claim_size=max(PROCESSES,self.segment_limit/NOMINAL_PARITIONS)
+        if self.flush_time is not None:
+            # results that arrive while AUTOTUNECOMMITFRACTION of the
+            # time is spent flushing
+            self.flush_size=int(min(max(self.result_rate*self.flush_time/AUTOTUNECOMMITFRACTION,PROCESSES),AUTOTUNEMAXFLUSH))
+
+TUNER=DbAutoTuner('--auto-tune' in sys.argv)
+
+def db_more_work(batch_table,CONNECTION,CURSOR,number_in_flight=0):
     """Checks the database for more work to be done."""
-    if PROCESSES == 1:
-        # ignore all hostname designations if only one process
-        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE;"
-        CURSOR.execute(selected_batch_string)
-        selected=CURSOR.fetchall()
+    if IGNORE_HOSTNAME:
+        # ignore all hostname designations if only one process or host
+        selected=BACKEND.select_pending(CURSOR,batch_table,None,1)
+        CONNECTION.commit()
+    elif '--claim' in sys.argv:
+        # claim another chunk once the work already held by this host
+        # would not keep the pool full
+        number_pending=BACKEND.count_pending(CURSOR,batch_table,THEHOSTNAME)
+        if number_pending - number_in_flight < PROCESSES:
+            number_pending+=BACKEND.claim(CONNECTION,CURSOR,batch_table,THEHOSTNAME,TUNER.claim_size,LEASETIME)
+        else:
+            CONNECTION.commit()
+        return number_pending > 0
     else:
-        # is there work for this hostname
-        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + THEHOSTNAME + "' AND done=FALSE;"
-        CURSOR.execute(selected_batch_string)
-        selected=CURSOR.fetchall()
+        # is there work for this hostname, only need to know if there
+        # is any
+        selected=BACKEND.select_pending(CURSOR,batch_table,THEHOSTNAME,1)
         if selected == []:
             # check if there is unassigned work
-            selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE;"
-            CURSOR.execute(selected_unassigned_string)
-            unassigned=CURSOR.fetchall()
-            if unassigned != []:
-                # TODO: I'd like to get this into one select that does
-                #       everything keep waiting for 5-10s at a time
-                #       until some work is assigned or no more work is
-                #       available
-                while selected == [] and unassigned != []:
-                    time.sleep(WORKWAIT)
-                    # TODO: selected unassigned and hostname stuff
-                    #       together distinguish here rather than doing 2
-                    #       selects
-                    CURSOR.execute(selected_batch_string)
-                    selected=CURSOR.fetchall()
-                    if selected == []:
-                        CURSOR.execute(selected_unassigned_string)
-                        unassigned=CURSOR.fetchall()
-                    else:
-                        unassigned == None
-                if selected == [] and unassigned == []:
-                    return False
-            else:
+            unassigned=BACKEND.select_unassigned(CURSOR,batch_table,1)
+        # never left idle in a transaction while the segment solves, the
+        # lock on batch_table would hold up any ALTER TABLE on it
+        CONNECTION.commit()
+        if selected == []:
+            # keep waiting until some work is assigned or no more work
+            # is available, db_watcher.py announces every assignment so
+            # this only checks again when something changes or after
+            # EVENTTIMEOUT in case an event was missed
+            while selected == [] and unassigned != []:
+                BACKEND.wait_for_event(LISTEN_CONNECTION,EVENTTIMEOUT,lambda payload: payload == 'assigned ' + THEHOSTNAME)
+                selected=BACKEND.select_pending(CURSOR,batch_table,THEHOSTNAME,1)
+                if selected == []:
+                    unassigned=BACKEND.select_unassigned(CURSOR,batch_table,1)
+                CONNECTION.commit()
+            if selected == []:
                 # no unassigned work and no work for this host, return
                 # False because this db_solver is done
                 return False
     # return True if we make it here and there is more work
     return (selected != [])
 
+# the columns of a dbtable that make up a solver spec
+SPEC_COLUMNS=['solver_object','method_properties','ode_properties','incoming_properties_keys','outgoing_properties_keys']
+
+def db_load_segment(CURSOR,selected):
+    """Load the solver specs and incoming properties for a segment of
+work.  Everything is grouped by dbtable and selected for many
+solve_numbers at once, so a segment costs a handful of queries rather
+than two per solve_number.
+
+    **Returns**
+      tuple:
+        A dictionary of solve_number -> (spec_id,incoming_properties_dict)
+        and a dictionary of solve_number -> dbtable.
+
+    """
+    dbtable_dict={}
+    solve_numbers_by_dbtable={}
+    for dbtable,solve_number in selected:
+        dbtable_dict[solve_number]=dbtable
+        solve_numbers_by_dbtable.setdefault(dbtable,[]).append(solve_number)
+    selected_solver_dict={}
+    for dbtable,solve_numbers in solve_numbers_by_dbtable.iteritems():
+        spec_rows=BACKEND.select_problems(CURSOR,dbtable,SPEC_COLUMNS,solve_numbers)
+        selected_solver_dict.update(db_load_incoming(CURSOR,dbtable,spec_rows))
+    return selected_solver_dict,dbtable_dict
+
+def db_load_incoming(CURSOR,dbtable,spec_rows):
+    """Intern the specs of spec_rows, each solve_number followed by the
+SPEC_COLUMNS, and load the incoming properties of each problem.
+
+    **Returns**
+      dict:
+        solve_number -> (spec_id,incoming_properties_dict)
+
+    """
+    selected_solver_dict={}
+    spec_id_by_solve_number={}
+    # problems with the same incoming keys share one select
+    solve_numbers_by_keys={}
+    for row in spec_rows:
+        spec_id_by_solve_number[row[0]]=db_intern_spec(dbtable,row[1:6])
+        solve_numbers_by_keys.setdefault(tuple(row[4]),[]).append(row[0])
+    for incoming_properties_keys,keyed_solve_numbers in solve_numbers_by_keys.iteritems():
+        for row in BACKEND.select_problems(CURSOR,dbtable,incoming_properties_keys,keyed_solve_numbers):
+            incoming_properties_dict=dict(zip(incoming_properties_keys,[db_array_value(v) for v in row[1:]]))
+            selected_solver_dict[row[0]]=(spec_id_by_solve_number[row[0]],incoming_properties_dict)
+    return selected_solver_dict
+
+class DbResultJournal(object):
+    """An append-only journal of results not yet committed, so they
+survive the coordinator dying and are replayed by db_replay_journals
+when db_solver.py starts again on the same host and batch table.
+
+    Each record is a pickled (dbtable,solve_number,outgoing_properties_dict),
+    or (None,solve_number,{'error':...,'attempts':...}) for a failure, or
+    (None,solve_number,{'elapsed':...}) for a timeout,
+    flushed to the operating system as soon as it is written.  Once the
+    results are committed the file is removed, the next record starts a
+    new one.
+
+    """
+    # so journals of sinks in the same process never share a file
+    number_opened=0
+
+    def __init__(self,batch_table):
+        self.batch_table=batch_table
+        self.fh=None
+        self.path=None
+
+    def write(self,dbtable,solve_number,outgoing_properties_dict):
+        if self.fh is None:
+            DbResultJournal.number_opened+=1
+            self.path=os.path.join(db_journal_dir(),db_journal_prefix(self.batch_table) + str(os.getpid()) + '_' + str(DbResultJournal.number_opened) + '.journal')
+            self.fh=open(self.path,'ab')
+        cPickle.dump((dbtable,solve_number,outgoing_properties_dict),self.fh,cPickle.HIGHEST_PROTOCOL)
+        self.fh.flush()
+
+    def discard(self):
+        """Remove the journal once everything in it is committed."""
+        if self.fh is not None:
+            self.fh.close()
+            os.remove(self.path)
+            self.fh=None
+            self.path=None
+
+def db_journal_dir():
+    journal_dir=os.path.expanduser(TMPPATH+'/db_solver_journal')
+    if not os.path.exists(journal_dir):
+        os_makedirs(journal_dir)
+    return journal_dir
+
+def db_journal_prefix(batch_table):
+    return 'db_solver_' + THEHOSTNAME + '_' + batch_table + '_'
+
+def db_pid_alive(pid):
+    """Whether a process other than this one with this pid is running."""
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid,0)
+    except OSError,e:
+        return e.errno == errno.EPERM
+    return True
+
+def db_replay_journals(CONNECTION,CURSOR,batch_table):
+    """Write back and commit any results journaled by an earlier
+db_solver.py on this host that died before committing them.  Writing
+back a result that did get committed just writes the same values again.
+
+    **Returns**
+      int:
+        The number of results replayed.
+
+    """
+    # the rest of the name must be exactly <pid>_<number>.journal,
+    # otherwise batch tables that extend this name would match too
+    journal_regexp=re.compile(re.escape(db_journal_prefix(batch_table)) + r'(\d+)_\d+\.journal$')
+    journal_paths=[]
+    for journal_name in sorted(os.listdir(db_journal_dir())):
+        journal_match=journal_regexp.match(journal_name)
+        if journal_match is None:
+            continue
+        if db_pid_alive(int(journal_match.group(1))):
+            # belongs to another db_solver.py still running on this
+            # host and batch table
+            continue
+        journal_paths.append(os.path.join(db_journal_dir(),journal_name))
+    number_replayed=0
+    for journal_path in journal_paths:
+        result_sink=DbResultSink(batch_table)
+        fh=open(journal_path,'rb')
+        while True:
+            try:
+                dbtable,solve_number,outgoing_properties_dict=cPickle.load(fh)
+            except EOFError:
+                break
+            except Exception:
+                # the last record was cut off by the crash
+                print(THEHOSTNAME, "Stopped reading truncated journal: %s" % journal_path)
+                break
+            if dbtable is None and 'elapsed' in outgoing_properties_dict:
+                result_sink.add_timeout(solve_number,outgoing_properties_dict['elapsed'])
+            elif dbtable is None:
+                result_sink.add_failure(solve_number,outgoing_properties_dict['error'],outgoing_properties_dict['attempts'])
+            else:
+                result_sink.add(dbtable,solve_number,outgoing_properties_dict)
+        fh.close()
+        print(THEHOSTNAME, "Replaying %s results from journal: %s" % (len(result_sink),journal_path))
+        sys.stdout.flush()
+        number_replayed+=len(result_sink)
+        if len(result_sink) > 0:
+            db_flush_results(CONNECTION,CURSOR,result_sink)
+        os.remove(journal_path)
+    return number_replayed
+
+class DbResultSink(object):
+    """Collects outgoing properties and writes them back to the database
+in bulk.
+
+    Results are grouped by dbtable and set of outgoing keys, each group
+    is written with one bulk operation of the backend (COPY into a
+    staging table for PostgreSQL) and the batch table gets one update
+    per flush.  Problems that failed for good are settled as done with
+    their error.  Nothing is committed here, that is left to the
+    caller, whose cursor is passed to flush().  With a journal every
+    result is also journaled as it is added, until committed() is
+    called.
+
+    """
+    def __init__(self,batch_table,journal=None):
+        self.batch_table=batch_table
+        self.journal=journal
+        self.pending={}
+        self.solve_numbers=[]
+        self.failures=[]
+        self.timeouts=[]
+
+    def __len__(self):
+        return len(self.solve_numbers)+len(self.failures)+len(self.timeouts)
+
+    def add(self,dbtable,solve_number,outgoing_properties_dict):
+        outgoing_properties_keys=tuple(sorted(outgoing_properties_dict.keys()))
+        self.pending.setdefault((dbtable,outgoing_properties_keys),[]).append((solve_number,outgoing_properties_dict))
+        self.solve_numbers.append(solve_number)
+        if self.journal is not None:
+            self.journal.write(dbtable,solve_number,outgoing_properties_dict)
+
+    def add_failure(self,solve_number,error,attempts):
+        self.failures.append((solve_number,error,attempts))
+        if self.journal is not None:
+            self.journal.write(None,solve_number,{'error':error,'attempts':attempts})
+
+    def add_timeout(self,solve_number,elapsed):
+        self.timeouts.append((solve_number,elapsed))
+        if self.journal is not None:
+            self.journal.write(None,solve_number,{'elapsed':elapsed})
+
+    def committed(self):
+        """Everything flushed so far has been committed."""
+        if self.journal is not None:
+            self.journal.discard()
+
+    def flush(self,CURSOR):
+        for i,((dbtable,outgoing_properties_keys),rows) in enumerate(self.pending.iteritems()):
+            BACKEND.write_results(CURSOR,i,dbtable,outgoing_properties_keys,rows,METRICS)
+        with METRICS.phase('execute'):
+            if self.solve_numbers != []:
+                BACKEND.mark_done(CURSOR,self.batch_table,self.solve_numbers)
+            if self.failures != []:
+                BACKEND.mark_failed(CURSOR,self.batch_table,self.failures)
+            if self.timeouts != []:
+                BACKEND.mark_timed_out(CURSOR,self.batch_table,self.timeouts)
+        self.pending={}
+        self.solve_numbers=[]
+        self.failures=[]
+        self.timeouts=[]
+
+def db_flush_results(CONNECTION,CURSOR,result_sink):
+    """Write back and commit everything queued in result_sink, letting
+db_watcher.py know this host has finished some work."""
+    flush_time=TIME_TIME()
+    print("Updating...")
+    sys.stdout.flush()
+    result_sink.flush(CURSOR)
+    # db_watcher.py sizes assignments from the number of processes
+    BACKEND.notify(CURSOR,result_sink.batch_table,'done ' + THEHOSTNAME + ' ' + str(PROCESSES))
+    print("Committing...")
+    sys.stdout.flush()
+    with METRICS.phase('commit'):
+        CONNECTION.commit()
+    result_sink.committed()
+    TUNER.record_flush(TIME_TIME()-flush_time)
+    print("Done committing.")
+    sys.stdout.flush()
+
+def db_select_segment(batch_table,CURSOR,in_flight):
+    """Select the next segment of work for this host, leaving out
+anything already in flight."""
+    if IGNORE_HOSTNAME:
+        return BACKEND.select_pending(CURSOR,batch_table,None,TUNER.segment_limit,in_flight)
+    else:
+        return BACKEND.select_pending(CURSOR,batch_table,THEHOSTNAME,TUNER.segment_limit,in_flight)
+
+class DbResultWriter(object):
+    """Writes back and commits result sinks on a seperate thread and
+connection, so results keep being collected and work keeps being
+dispatched meanwhile.
+
+    At most WRITERQUEUESIZE sinks wait to be written, past that put()
+    blocks until the writer catches up.  Each sink put gets a ticket and
+    wait(ticket) blocks until that sink and everything before it is
+    committed.
+
+    """
+    def __init__(self):
+        self.CONNECTION,self.CURSOR=BACKEND.connect()
+        self.queue=Queue.Queue(maxsize=WRITERQUEUESIZE)
+        self.condition=threading.Condition()
+        self.number_put=0
+        self.number_committed=0
+        self.exc_info=None
+        self.thread=threading.Thread(target=self._run)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def put(self,result_sink):
+        """Queue result_sink to be written, returns its ticket."""
+        self._check()
+        if len(result_sink) > 0:
+            with METRICS.phase('writer wait'):
+                self.queue.put(result_sink)
+            self.number_put+=1
+        return self.number_put
+
+    def wait(self,ticket):
+        with self.condition:
+            while self.number_committed < ticket:
+                self.condition.wait()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.CONNECTION.commit()
+        self.CONNECTION.close()
+        self._check()
+
+    def _check(self):
+        if self.exc_info is not None:
+            exc_info=self.exc_info
+            self.exc_info=None
+            raise exc_info[0],exc_info[1],exc_info[2]
+
+    def _run(self):
+        while True:
+            result_sink=self.queue.get()
+            if result_sink is None:
+                break
+            # after an error keep draining so put() never blocks, the
+            # results are still in their journals
+            if self.exc_info is None:
+                try:
+                    db_flush_results(self.CONNECTION,self.CURSOR,result_sink)
+                except Exception:
+                    self.exc_info=sys.exc_info()
+            with self.condition:
+                self.number_committed+=1
+                self.condition.notify_all()
+
+class DbSegmentPrefetcher(object):
+    """Loads the next segment on a seperate thread and connection, so
+this happens while the current segment solves rather than with the pool
+sitting idle.
+
+    """
+    def __init__(self,batch_table,writer):
+        self.batch_table=batch_table
+        self.writer=writer
+        self.CONNECTION,self.CURSOR=BACKEND.connect()
+        self.thread=None
+        self.segment=None
+        self.exc_info=None
+
+    def request(self,in_flight,ticket=0):
+        """Start loading the next segment once the writer has committed
+through ticket, leaving out the solve_numbers in in_flight."""
+        self.thread=threading.Thread(target=self._run,args=(list(in_flight),ticket))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def get(self,in_flight):
+        """Wait for and return the requested segment as given by
+db_load_segment, requesting one now if none has been."""
+        if self.thread is None:
+            self.request(in_flight)
+        self.thread.join()
+        self.thread=None
+        if self.exc_info is not None:
+            exc_info=self.exc_info
+            self.exc_info=None
+            raise exc_info[0],exc_info[1],exc_info[2]
+        return self.segment
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
+        self.CONNECTION.commit()
+        self.CONNECTION.close()
+
+    def _run(self,in_flight,ticket):
+        try:
+            # so nothing already solved is selected again
+            self.writer.wait(ticket)
+            with METRICS.phase('segment fetch'):
+                selected=db_select_segment(self.batch_table,self.CURSOR,in_flight)
+            with METRICS.phase('spec build'):
+                self.segment=db_load_segment(self.CURSOR,selected)
+            if COST_MODEL is not None:
+                with METRICS.phase('cost model'):
+                    COST_MODEL.seed(self.CURSOR,set(self.segment[1].values()))
+            self.CONNECTION.commit()
+        except Exception:
+            self.exc_info=sys.exc_info()
+
+class DbLeaseHeartbeat(object):
+    """Renews the lease of this host on everything assigned to it every
+LEASEHEARTBEAT seconds, on a seperate thread and connection, for as long
+as db_solver.py runs, with an 'alive' event each time.  If this host
+dies its work is unassigned once the lease runs out.
+
+    """
+    def __init__(self,batch_table):
+        self.batch_table=batch_table
+        self.CONNECTION,self.CURSOR=BACKEND.connect()
+        self.stopped=threading.Event()
+        self.thread=threading.Thread(target=self._run)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.CONNECTION.close()
+
+    def _run(self):
+        # right away too, for anything assigned before a restart
+        while True:
+            try:
+                BACKEND.renew_leases(self.CURSOR,self.batch_table,THEHOSTNAME,LEASETIME)
+                # so db_watcher.py gives work to this host again if its
+                # leases ever expired
+                BACKEND.notify(self.CURSOR,self.batch_table,'alive ' + THEHOSTNAME)
+                self.CONNECTION.commit()
+            except Exception:
+                # LEASETIME covers a few missed heartbeats
+                traceback.print_exc()
+                self.CONNECTION.rollback()
+            if self.stopped.wait(LEASEHEARTBEAT):
+                break
+
 # XXXX: POOL must be defined before main() function but after the
 #       workers
 if __name__ == '__main__':
     if len(sys.argv) > 3:
-        POOL = multiprocessing.Pool(processes=PROCESSES,maxtasksperchild=MAXTASKSPERCHILD)
+        # workers only record what they are running if something might
+        # have a time budget, the spare slots are for replacements
+        # started before a slot is seen to be free
+        if TASKTIMEBUDGETS:
+            TASK_SLOTS=multiprocessing.Array('d',4*2*PROCESSES)
+        else:
+            TASK_SLOTS=None
+        if PROCESSES==1:
+            POOL = multiprocessing.Pool(processes=PROCESSES,initializer=db_solver_worker_init,initargs=(None,'--verbose' in sys.argv,TASK_SLOTS),maxtasksperchild=MAXTASKSPERCHILD)
+        else:
+            POOL = multiprocessing.Pool(processes=PROCESSES,initializer=db_solver_worker_init,initargs=(SPECIFIC_LOGDIR,'--verbose' in sys.argv,TASK_SLOTS),maxtasksperchild=MAXTASKSPERCHILD)
 
 def main(argv):
     """The main loop of db_solver.py.
     """
     batch_table=argv[3]
     global POOL
+    global WATCHDOG
+    global COST_MODEL
+    global LISTEN_CONNECTION
     global SPECIFIC_LOGDIR
     # connect to the database
-    CONNECTION,CURSOR=open_database(None,None)
-    # create the Queue
-    m = multiprocessing.Manager()
-    q = m.Queue()
+    CONNECTION,CURSOR=BACKEND.connect()
+    # failures are recorded on the batch table
+    BACKEND.add_columns(CONNECTION,CURSOR,batch_table,[('error','text'),('attempts','integer'),('timed_out','boolean'),('elapsed','double precision')])
+    BACKEND.create_lease_table(CONNECTION,CURSOR,batch_table)
+    if IGNORE_HOSTNAME:
+        heartbeat=None
+    else:
+        # keep the work assigned to this host while it runs
+        heartbeat=DbLeaseHeartbeat(batch_table)
+    if IGNORE_HOSTNAME or '--claim' in sys.argv:
+        # nothing to wait for
+        LISTEN_CONNECTION=None
+    else:
+        LISTEN_CONNECTION=BACKEND.listen(batch_table)
+    # results come back through callbacks
+    collector=DbResultCollector()
+    # --longest-first predicts worker times from problems already solved
+    # and dispatches the longest first to shorten the tail of a batch
+    if '--longest-first' in sys.argv:
+        COST_MODEL=DbCostModel()
+    if TASK_SLOTS is not None:
+        WATCHDOG=DbTaskWatchdog(batch_table,TASK_SLOTS,collector)
     # if only one process, ignore hostname find next batch of work,
     # this gets work if possible
-    solve_number_list=[]
-    limitpersegement_str=str(LIMITPERSEGMENT)
-    while db_more_work(batch_table,CURSOR) or solve_number_list != []:
-        selected_solver_dict={}
-        if PROCESSES == 1:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE LIMIT " + limitpersegement_str + ";"
-        else:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + THEHOSTNAME + "' AND done=FALSE LIMIT " + limitpersegement_str + ";"
-        CURSOR.execute(selected_batch_string)
-        selected=CURSOR.fetchall()
-        CONNECTION.commit()
+    speculative_flag='--speculative' in sys.argv
+    in_flight=DbInFlightRegistry()
+    # recent worker times for spotting stragglers
+    worker_times=collections.deque(maxlen=SPECULATIVESAMPLES)
+    dbtable_dict={}
+    worker_time_total=0.0
+    worker_time_count=0
+    # results that arrived after the last segment was requested, that
+    # segment may have been selected before they were committed
+    completed_since_request=set()
+    # --no-journal skips journaling results, nothing survives a crash
+    # between flushes but each result costs a little less
+    journal_flag='--no-journal' not in sys.argv
+    if journal_flag:
+        METRICS.count('problems replayed',db_replay_journals(CONNECTION,CURSOR,batch_table))
+    result_sink=DbResultSink(batch_table,DbResultJournal(batch_table) if journal_flag else None)
+    # --cache or --cache=path keeps results by solver spec and incoming
+    # properties, problems solved before are written back without
+    # being dispatched
+    if '--cache' in sys.argv or db_argv_value('--cache') is not None:
+        result_cache=DbResultCache(db_argv_value('--cache',os.path.join(TMPPATH,'db_solver_cache.sqlite')),RESULTCACHEMAXBYTES)
+    else:
+        result_cache=None
+    # solve_number -> cache key for problems in flight
+    cache_keys={}
+    # results are written back and committed in the background
+    writer=DbResultWriter()
+    prefetcher=DbSegmentPrefetcher(batch_table,writer)
+    while db_more_work(batch_table,CONNECTION,CURSOR,len(in_flight)) or len(in_flight) > 0:
         # build the select strings first
         print("==== "  + THEHOSTNAME + ": Building select strings and incoming properties ====")
         sys.stdout.flush()
         ##########
-        dbtable_dict={}
         # XXXX: this section was one of the biggest bottlenecks for
-        #       large numbers of easy problems indexing by
-        #       solve_number solves this issue for now, otherwise, it
-        #       scales quadratically or much worse once the number of
-        #       problems climbed above 100000
-        selectstring_list=[]
-        for dbtable,solve_number in selected:
-            dbtable_dict[solve_number]=dbtable
-            # TODO: do these selects seperately
-            # TODO: trim selected_solver to ensure solve_number is not used
-            solve_number_str=str(solve_number)
-            selectstring = "SELECT solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys FROM " + dbtable + " WHERE solve_number=" + solve_number_str + ';'
-            CURSOR.execute(selectstring)
-            selected_solver=CURSOR.fetchall()
-            # select the standard things
-            incoming_properties_keys   = selected_solver[0][3]
-            # select incoming
-            # TODO: try to only do this once....
-            incoming_properties_keys_quoted = ['"' + k + '"' for k in incoming_properties_keys]
-            selecting_incoming_string="SELECT " + ','.join(incoming_properties_keys_quoted) + " FROM " + dbtable +  " WHERE solve_number=" + solve_number_str + ";"
-            CURSOR.execute(selecting_incoming_string)
-            incoming_properties_values=CURSOR.fetchall()[0]
-            incoming_properties_dict=dict(zip(incoming_properties_keys,incoming_properties_values))
-            selected_solver_dict[solve_number]=(selected_solver,incoming_properties_dict)
-        CONNECTION.commit()
+        #       large numbers of easy problems, two selects per
+        #       solve_number scaled badly once the number of problems
+        #       climbed above 100000, now done a dbtable at a time and
+        #       usually already loaded while the last segment solved
+        selected_solver_dict,segment_dbtable_dict=prefetcher.get(in_flight.keys())
+        # keep dbtables for anything still in flight from an earlier segment
+        dbtable_dict.update(segment_dbtable_dict)
         print("==== " + THEHOSTNAME + ": Starting solution ==========")
         sys.stdout.flush()
+        tasks=[]
         for solve_number in selected_solver_dict:
-            if solve_number in solve_number_list:
+            if solve_number in in_flight or solve_number in completed_since_request:
                 continue
-            if PROCESSES==1:
-                POOL.apply_async(db_solver_worker,(q,solve_number,selected_solver_dict[solve_number][0],selected_solver_dict[solve_number][1]))
-            else:
-                #
-                POOL.apply_async(db_solver_worker,(q,solve_number,selected_solver_dict[solve_number][0],selected_solver_dict[solve_number][1],SPECIFIC_LOGDIR))
-            solve_number_list.append(solve_number)
+            tasks.append((solve_number,selected_solver_dict[solve_number][0],selected_solver_dict[solve_number][1]))
+        if result_cache is not None:
+            with METRICS.phase('cache lookup'):
+                result_cache.flush()
+                for solve_number,spec_id,incoming_properties_dict in tasks:
+                    cache_key=db_cache_key(spec_id,incoming_properties_dict)
+                    if cache_key is not None:
+                        cache_keys[solve_number]=cache_key
+                cached=result_cache.get_many([cache_keys[task[0]] for task in tasks if task[0] in cache_keys])
+            uncached_tasks=[]
+            for task in tasks:
+                solve_number=task[0]
+                if solve_number in cache_keys and cache_keys[solve_number] in cached:
+                    # straight to the usual write back
+                    result_sink.add(dbtable_dict.pop(solve_number),solve_number,dict(cached[cache_keys.pop(solve_number)]))
+                    completed_since_request.add(solve_number)
+                else:
+                    uncached_tasks.append(task)
+            METRICS.count('cache hits',len(tasks)-len(uncached_tasks))
+            tasks=uncached_tasks
+        # cheap problems go out several at a time so pickling and IPC
+        # do not cost more than the solve
+        chunksize=db_chunk_size(len(tasks),worker_time_total,worker_time_count)
+        if COST_MODEL is not None:
+            with METRICS.phase('cost model'):
+                chunks=db_longest_first(tasks,chunksize)
+        else:
+            # lowest first, db_watcher.py reclaims the highest
+            tasks.sort(key=lambda task: task[0])
+            chunks=[tasks[i:i+chunksize] for i in xrange(0,len(tasks),chunksize)]
+        # only DISPATCHAHEAD chunks per process go to the pool, the rest
+        # is held so work moved to another host is not solved here too
+        for chunk in chunks:
+            in_flight.hold(chunk)
+        dispatch_limit=DISPATCHAHEAD*PROCESSES*chunksize
+        METRICS.count('segments')
+        METRICS.count('problems dispatched',len(tasks))
+        TUNER.record_solves(worker_time_total,worker_time_count)
+        if TUNER.enabled:
+            print("==== " + THEHOSTNAME + ": Segment size: %s Flush size: %s Claim size: %s ====" % (TUNER.segment_limit,TUNER.flush_size,TUNER.claim_size))
+        # write back the last segment and load the next one while this
+        # one solves
+        prefetcher.request(in_flight.keys(),writer.put(result_sink))
+        completed_since_request=set()
+        result_sink=DbResultSink(batch_table,DbResultJournal(batch_table) if journal_flag else None)
         ##########
         print("==== "  + THEHOSTNAME + ": Processing solutions ====")
         # TODO: add some text to explain this
-        print(len(solve_number_list))
+        print(len(in_flight))
         sys.stdout.flush()
-        update_strings=[]
-        # TODO: this is many statements pasted as one right now, could be made faster into fewer statements
-        # TODO: best way will be bulk update using temp table for each
-        #       dbtable from
-        #       https://dba.stackexchange.com/questions/41059/optimizing-bulk-update-performance-in-postgresql
-        # TODO: http://tapoueh.org/blog/2013/03/15-batch-update.html
-        while solve_number_list != []:
-            # XXXX: I think this should be good, this blocks, but won't run unless there are things left
-            # TODO: this blocks... hence the machinery above
-            try:
-                outgoing=q.get(timeout=5)
-                solve_number=outgoing[0]
-                outgoing_properties_dict=outgoing[1]
-                outgoing_properties_keys=outgoing_properties_dict.keys()
-                dbtable=dbtable_dict[solve_number]
-                solve_number_list.remove(solve_number)
-                #
-                # TODO: want to copy to table...
-                outgoing_properties_strings = ['\"' + k + '\"=%(' + k + ')s' for k in outgoing_properties_keys]
-                solve_number_str=str(solve_number)
-                outgoing_properties_update_string="UPDATE " + dbtable + " SET " + ', '.join(outgoing_properties_strings) + " WHERE solve_number=" + solve_number_str + ";"
-                outgoing_properties_update_string=CURSOR.mogrify(outgoing_properties_update_string,outgoing_properties_dict)
-                update_strings.append(outgoing_properties_update_string)
-                # update the work table
-                update_batch_table_string="UPDATE " + batch_table + " SET done=TRUE WHERE solve_number=" + solve_number_str + ";"
-                update_strings.append(update_batch_table_string)
-            except Queue.Empty:
-                print("Queue empty...")
-                sys.stdout.flush()
-                # if queue times out and processors are not all doing work, try and get more work
-                if len(solve_number_list) <= PROCESSES and '--serial' not in sys.argv:
-                    # this should not take too long... but maybe add
-                    # timeout...  update before breaking
-                    if update_strings != []:
-                        print("Updating...")
-                        sys.stdout.flush()
-                        CURSOR.execute(''.join(update_strings))
-                        print("Committing...")
-                        sys.stdout.flush()
-                        CONNECTION.commit()
-                        print("Done committing.")
-                        sys.stdout.flush()
-                        update_strings=[]
-                    break
+        while len(in_flight) > 0:
+            METRICS.maybe_dump()
+            for solve_number in db_dispatch_held(CONNECTION,CURSOR,batch_table,in_flight,collector,dispatch_limit,chunksize):
+                cache_keys.pop(solve_number,None)
+                dbtable_dict.pop(solve_number)
+                METRICS.count('problems moved to other hosts')
+            if len(in_flight) == 0:
+                break
+            queue_wait_time=TIME_TIME()
+            if speculative_flag and len(in_flight) < PROCESSES:
+                # cores are idle at the tail of the batch, wake up
+                # periodically to look for stragglers
+                try:
+                    solve_number,outgoing_properties_dict,error=collector.get(timeout=SPECULATIVECHECK)
+                except Queue.Empty:
+                    METRICS.add('queue wait',TIME_TIME()-queue_wait_time)
+                    threshold=db_straggler_threshold(worker_times)
+                    if threshold is not None:
+                        for solve_number in in_flight.stragglers(threshold,SPECULATIVEMAXATTEMPTS)[:max(0,PROCESSES-in_flight.copies())]:
+                            print(THEHOSTNAME, "Speculatively dispatching: %s" % solve_number)
+                            db_dispatch([in_flight.redispatch(solve_number)],collector)
+                            METRICS.count('speculative dispatches')
+                    continue
+            else:
+                # blocks until the next result arrives
+                solve_number,outgoing_properties_dict,error=collector.get()
+            METRICS.add('queue wait',TIME_TIME()-queue_wait_time)
+            if isinstance(error,DbTaskLost):
+                if solve_number in in_flight:
+                    db_dispatch([in_flight.requeue(solve_number)],collector)
+                    METRICS.count('lost with timed out chunk')
+                continue
+            elif isinstance(error,DbTaskTimeout):
+                if not in_flight.complete(solve_number):
+                    continue
+                # no retries, it would only time out again
+                print(THEHOSTNAME, "Timed out after %s seconds: %s" % (error.elapsed,solve_number))
+                completed_since_request.add(solve_number)
+                cache_keys.pop(solve_number,None)
+                dbtable_dict.pop(solve_number)
+                result_sink.add_timeout(solve_number,error.elapsed)
+                METRICS.count('problems timed out')
+            elif error is not None:
+                record=in_flight.fail(solve_number)
+                if record is None:
+                    # another copy already finished
+                    continue
+                METRICS.count('failures')
+                if record['attempts'] > record['failures']:
+                    # wait for the other copies
+                    continue
+                elif record['attempts'] < RETRYATTEMPTS:
+                    print(THEHOSTNAME, "Retrying failed problem: %s" % solve_number)
+                    db_dispatch([in_flight.redispatch(solve_number)],collector)
+                    METRICS.count('retries')
+                    continue
+                # give up, settle it as done with the error so this
+                # host moves on
+                print(THEHOSTNAME, "Giving up on failed problem: %s" % solve_number)
+                in_flight.complete(solve_number)
+                completed_since_request.add(solve_number)
+                cache_keys.pop(solve_number,None)
+                dbtable_dict.pop(solve_number)
+                result_sink.add_failure(solve_number,error,record['attempts'])
+                METRICS.count('problems failed')
+            elif solve_number not in in_flight:
+                # a slower copy of something already done
+                METRICS.count('duplicate results')
+                continue
+            else:
+                task=in_flight.complete(solve_number)['task']
+                if COST_MODEL is not None:
+                    COST_MODEL.add(task[1],task[2],outgoing_properties_dict['worker time'])
+                METRICS.add('solve',outgoing_properties_dict['worker time'])
+                completed_since_request.add(solve_number)
+                if solve_number in cache_keys:
+                    result_cache.put(cache_keys.pop(solve_number),outgoing_properties_dict)
+                worker_time_total+=outgoing_properties_dict['worker time']
+                worker_time_count+=1
+                worker_times.append(outgoing_properties_dict['worker time'])
+                result_sink.add(dbtable_dict.pop(solve_number),solve_number,outgoing_properties_dict)
             # TODO: make sure commits occur frequently, change based on batch size and such
             #       should know size of segment too, change to segment_size - 4
-            print(THEHOSTNAME, "Solve number list: %s" % len(solve_number_list))
-            # XXXX: divided by two because it is confusing not to have
-            #       these two numbers match spaces added for
-            #       readability
-            print(THEHOSTNAME, "Queued for update:    %s" % len(update_strings)/2)
+            print(THEHOSTNAME, "Solve number list: %s" % len(in_flight))
+            print(THEHOSTNAME, "Queued for update:  %s" % len(result_sink))
             sys.stdout.flush()
-            if len(update_strings) > MAXUPDATESTRINGS:
-                print("Updating...")
-                sys.stdout.flush()
-                CURSOR.execute(''.join(update_strings))
-                print("Committing...")
-                sys.stdout.flush()
-                CONNECTION.commit()
-                print("Done committing.")
-                sys.stdout.flush()
-                update_strings=[]
-            # TODO: a bare minimum sleep seems to be necessary to avoid spin locking
-            #       implementing using threading would be far better
-            time.sleep(0.01)
-        if update_strings != []:
-            CURSOR.execute(''.join(update_strings))
-            CONNECTION.commit()
-            update_strings=[]
+            if len(result_sink) > TUNER.flush_size:
+                writer.put(result_sink)
+                result_sink=DbResultSink(batch_table,DbResultJournal(batch_table) if journal_flag else None)
+            # dispatch the next segment while every process still has
+            # something queued, it should already be loaded
+            if len(in_flight) <= 2*PROCESSES and '--serial' not in sys.argv:
+                break
+    prefetcher.close()
+    writer.put(result_sink)
+    writer.close()
+    if heartbeat is not None:
+        heartbeat.close()
+    if result_cache is not None:
+        result_cache.close()
+    if WATCHDOG is not None and WATCHDOG.number_killed > 0:
+        # the pool still waits on chunks lost with killed workers, but
+        # everything has been accounted for
+        POOL.terminate()
+    METRICS.dump()
     CONNECTION.commit()
     CONNECTION.close()
+    if LISTEN_CONNECTION is not None:
+        LISTEN_CONNECTION.close()
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
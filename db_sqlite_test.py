@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# some simple tests of the db_solver.py pipeline that need no database
+# server, db_solver.py runs end-to-end against an SQLite database
+#
+#   python db_sqlite_test.py
+#
+# db_solver.py imports the test solver from this file, so nothing here
+# runs on import.
+
+import os,sys
+import math
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from db_common import *
+from db_common import db_copy_text
+from db_defaults import *
+
+__all__=['DbTestSolver','DB_TEST_METHOD_PROPERTIES','DB_TEST_ODE_PROPERTIES']
+
+DB_TEST_METHOD_PROPERTIES={}
+DB_TEST_ODE_PROPERTIES={}
+
+# seconds a 'slow' problem may run in the end-to-end test
+DB_TEST_BUDGET=2.0
+
+class DbTestSolver(object):
+    """Returns y=2*x for the incoming property x, how it gets there
+depends on the incoming property mode:
+
+      ok:    straight away
+      flaky: raises the first time, succeeds when retried
+      fail:  always raises
+      slow:  runs far past DB_TEST_BUDGET
+
+    """
+    def __init__(self,method_default_properties=None,ode_default_properties=None,incoming_properties=None):
+        self.incoming_properties=incoming_properties
+
+    def run(self,theglobals):
+        x=self.incoming_properties['x']
+        mode=self.incoming_properties['mode']
+        if mode == 'flaky':
+            marker_path=os.path.join(os.getenv('PYMATHDBTMP'),'flaky_' + str(int(x)))
+            if not os.path.exists(marker_path):
+                open(marker_path,'w').close()
+                raise ValueError("First attempt at flaky problem: %s" % x)
+        elif mode == 'fail':
+            raise ValueError("Failing problem: %s" % x)
+        elif mode == 'slow':
+            time.sleep(60.0)
+        return {'y':2.0*x}
+
+def db_test_create_tables(BACKEND,CONNECTION,CURSOR,dbtable,batch_table,modes):
+    """Create a dbtable and batch table with a problem for each mode."""
+    CURSOR.execute("CREATE TABLE " + dbtable + " (solve_number integer PRIMARY KEY, solver_object text, method_properties text, ode_properties text, incoming_properties_keys " + BACKEND.text_array_type + ", outgoing_properties_keys " + BACKEND.text_array_type + ', x double precision, mode text, y double precision, "worker time" double precision);')
+    CURSOR.execute("CREATE TABLE " + batch_table + " (table_name text, solve_number integer PRIMARY KEY, hostname text, done boolean);")
+    insert_string="INSERT INTO " + dbtable + " (solve_number,solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys,x,mode) VALUES (" + ','.join([BACKEND.placeholder]*8) + ");"
+    CURSOR.executemany(insert_string,[(solve_number,'<<DbTestSolver>>','<<DB_TEST_METHOD_PROPERTIES>>','<<DB_TEST_ODE_PROPERTIES>>',['x','mode'],['y'],float(solve_number),mode)
+                                      for solve_number,mode in enumerate(modes)])
+    insert_string="INSERT INTO " + batch_table + " (table_name,solve_number,hostname,done) VALUES (" + ','.join([BACKEND.placeholder]*4) + ");"
+    CURSOR.executemany(insert_string,[(dbtable,solve_number,None,False) for solve_number in xrange(len(modes))])
+    CONNECTION.commit()
+
+def test_db_solver_sqlite():
+    tmp_path=tempfile.mkdtemp(prefix='db_sqlite_test_')
+    try:
+        # db_solver.py picks this up from the path given as its first
+        # argument
+        fh=open(os.path.join(tmp_path,'db_defaults_local.py'),'w')
+        fh.write("TASKTIMEBUDGETS={'db_test_batch':%r}\n" % DB_TEST_BUDGET)
+        fh.close()
+        database_path=os.path.join(tmp_path,'db_test.sqlite')
+        BACKEND=DbSqliteBackend(database_path)
+        CONNECTION,CURSOR=BACKEND.connect()
+        modes=['ok']*20 + ['flaky','fail','slow']
+        db_test_create_tables(BACKEND,CONNECTION,CURSOR,'db_test','db_test_batch',modes)
+        environment=dict(os.environ)
+        environment['PYMATHDBTMP']=tmp_path
+        package_path=os.path.dirname(os.path.abspath(__file__))
+        p=subprocess.Popen([sys.executable,os.path.join(package_path,'db_solver.py'),tmp_path,'db_sqlite_test','db_test_batch','--sqlite=' + database_path],
+                           stdout=subprocess.PIPE,stderr=subprocess.STDOUT,env=environment,cwd=package_path)
+        solver_output=p.communicate()[0]
+        assert p.returncode == 0, solver_output
+        CURSOR.execute("SELECT b.solve_number,b.done,b.error,b.attempts,b.timed_out,b.elapsed,d.y FROM db_test_batch AS b JOIN db_test AS d ON b.solve_number=d.solve_number;")
+        rows=dict([(row[0],row[1:]) for row in CURSOR.fetchall()])
+        CONNECTION.close()
+        for solve_number,mode in enumerate(modes):
+            done,error,attempts,timed_out,elapsed,y=rows[solve_number]
+            assert done, (mode,rows[solve_number])
+            if mode in ('ok','flaky'):
+                assert y == 2.0*solve_number and error is None and not timed_out, (mode,rows[solve_number])
+            elif mode == 'fail':
+                assert y is None and 'Failing problem' in error and attempts == RETRYATTEMPTS, (mode,rows[solve_number])
+            elif mode == 'slow':
+                assert y is None and timed_out and DB_TEST_BUDGET <= elapsed < 60.0, (mode,rows[solve_number])
+        assert os.path.exists(os.path.join(tmp_path,'flaky_' + str(modes.index('flaky'))))
+    finally:
+        shutil.rmtree(tmp_path)
+
+def test_db_array_round_trip():
+    for value in [np.arange(12,dtype=np.float64).reshape(3,4),
+                  np.array([1,-2,3],dtype=np.int32),
+                  np.array([[True,False]]),
+                  np.linspace(0.0,1.0,7)[::2],
+                  np.asfortranarray(np.arange(6.0).reshape(2,3)),
+                  np.zeros((0,3))]:
+        for compression_level in (0,6):
+            decoded=db_array_decode(db_array_encode(value,compression_level))
+            assert decoded.dtype == value.dtype and decoded.shape == value.shape, (value,decoded)
+            assert np.array_equal(decoded,value), (value,decoded)
+            # as read back from a bytea or BLOB column
+            decoded=db_array_value(buffer(db_array_encode(value,compression_level)))
+            assert np.array_equal(decoded,value), (value,decoded)
+    # anything else is left alone
+    assert db_array_value(buffer('not an array')) == buffer('not an array')
+    assert db_array_value(1.5) == 1.5
+
+def test_db_copy_text():
+    assert db_copy_text(None) == '\\N'
+    assert db_copy_text('a\tb\nc\\d\re') == 'a\\tb\\nc\\\\d\\re'
+    assert db_copy_text(u'\xe9') == '\xc3\xa9'
+    assert db_copy_text(True) == 't' and db_copy_text(np.bool_(False)) == 'f'
+    assert db_copy_text(np.int64(7)) == '7'
+    assert float(db_copy_text(0.1)) == 0.1
+    assert db_copy_text(float('nan')) == 'NaN'
+    assert db_copy_text(float('inf')) == 'Infinity' and db_copy_text(-float('inf')) == '-Infinity'
+    assert db_copy_text(['a','b"c',None]) == '{"a","b\\\\"c",NULL}'
+    assert db_copy_text(np.array([[1.5,2.0],[3.0,4.0]])) == '{{1.5,2.0},{3.0,4.0}}'
+    assert db_copy_text(['a\tb']) == '{"a\\tb"}'
+
+def db_test_import_watcher():
+    """db_watcher.py reads its solver path and module from sys.argv when
+imported."""
+    saved_argv=sys.argv
+    sys.argv=[saved_argv[0],os.path.dirname(os.path.abspath(__file__)),'db_defaults']
+    try:
+        import db_watcher
+    finally:
+        sys.argv=saved_argv
+    return db_watcher
+
+def test_db_host_scheduler_targets():
+    db_watcher=db_test_import_watcher()
+    scheduler=db_watcher.DbHostScheduler(['small','big'])
+    scheduler.record_event('done small 4')
+    scheduler.record_event('done big 12')
+    # nothing measured, shared by processes
+    assert scheduler.targets(1600) == {'small':400,'big':1200}
+    # never less than a problem per process
+    assert scheduler.targets(8) == {'small':4,'big':12}
+    # shared by rate so both finish together
+    scheduler.hosts['small']['rate']=10.0
+    scheduler.hosts['big']['rate']=30.0
+    assert scheduler.targets(1200) == {'small':300,'big':900}
+    # no more than SCHEDULERHORIZON seconds of work at once
+    targets=scheduler.targets(1000000)
+    assert targets == {'small':int(math.ceil(10.0*SCHEDULERHORIZON)),'big':int(math.ceil(30.0*SCHEDULERHORIZON))}
+    # a lost host gets nothing until it is alive again
+    scheduler.record_expired('small')
+    assert scheduler.targets(1200) == {'big':1200}
+    assert not scheduler.record_event('alive big')
+    assert scheduler.record_event('alive small')
+    assert scheduler.targets(1200) == {'small':300,'big':900}
+
+if __name__ == '__main__':
+    test_db_array_round_trip()
+    test_db_copy_text()
+    test_db_host_scheduler_targets()
+    test_db_solver_sqlite()
+    print("All tests passed")
@@ -25,6 +25,7 @@
 # along with this program. If not, see http://www.gnu.org/licenses/.
 
 import os,sys
+import tempfile
 # TODO: fix later
 from pymath_common import *
 sys.path.append(sys.argv[1])
@@ -34,68 +35,239 @@ exec('from ' + sys.argv[2] + ' import *')
 # TODO: settings here fix
 # from experiment_common import *
 
+from db_common import *
 from db_defaults import *
 try:
     from db_defaults_local import *
 except ImportError:
     pass
 
-# TODO: problem... assigns all work to one machine when doing small number of reference solutions
+# metrics are written under the PYMATHDBTMP environment variable, or
+# the system temporary directory if it is not set
+TMPPATH=os.getenv('PYMATHDBTMP',tempfile.gettempdir())
+
+class DbHostScheduler(object):
+    """Sizes the work assigned to each host from its measured completion
+rate, so that all hosts finish a batch at about the same time.
+
+    Rates come from the number of problems each host has done, sampled
+    while it has work.  Hosts without a rate yet are assumed to be as
+    fast per process as those with one, or just proportional to their
+    processes if no host has a rate yet.  db_solver.py gives its number
+    of processes in its 'done' events, TYPICAL_CORES until then.
+
+    A host whose leases expired is taken as lost and gets no more work
+    until a 'done' or 'alive' event shows it is running again.
+
+    """
+    def __init__(self,hostlist):
+        self.hosts={}
+        for host in hostlist:
+            self.hosts[host]={'processes':TYPICAL_CORES,
+                              'rate':None,
+                              'done':None,
+                              'time':None,
+                              'pending':0,
+                              'lost':False}
+
+    def record_event(self,payload):
+        """Accept function for wait_for_event, picks up the number of
+processes from 'done <hostname> <processes>' and hosts that are running
+again from 'alive <hostname>'."""
+        fields=payload.split()
+        if fields[0] == 'alive':
+            # only worth waking up for if the host was lost
+            if len(fields) == 2 and fields[1] in self.hosts and self.hosts[fields[1]]['lost']:
+                self.hosts[fields[1]]['lost']=False
+                return True
+            return False
+        if fields[0] != 'done':
+            return False
+        if len(fields) == 3 and fields[1] in self.hosts:
+            self.hosts[fields[1]]['processes']=int(fields[2])
+            self.hosts[fields[1]]['lost']=False
+        return True
+
+    def record_expired(self,host):
+        """The leases of host expired, so it is lost."""
+        if host in self.hosts:
+            self.hosts[host]['lost']=True
+
+    def alive_hosts(self):
+        return [host for host,hoststats in self.hosts.iteritems() if not hoststats['lost']]
+
+    def record_counts(self,host,number_pending,number_done,now):
+        """Update the rate of host from its number of problems done."""
+        hoststats=self.hosts[host]
+        if hoststats['time'] is None:
+            hoststats['done'],hoststats['time']=number_done,now
+        elif now-hoststats['time'] >= SCHEDULERSAMPLETIME:
+            # a host without work is not slow, so only sample while busy
+            if hoststats['pending'] > 0:
+                rate_sample=(number_done-hoststats['done'])/(now-hoststats['time'])
+                if hoststats['rate'] is None:
+                    hoststats['rate']=rate_sample
+                else:
+                    hoststats['rate']=(1.0-SCHEDULERSMOOTHING)*hoststats['rate']+SCHEDULERSMOOTHING*rate_sample
+            hoststats['done'],hoststats['time']=number_done,now
+        hoststats['pending']=number_pending
+
+    def rate(self,host):
+        """The measured or estimated problems per second of host, or None
+if no host has a rate yet."""
+        if self.hosts[host]['rate']:
+            return self.hosts[host]['rate']
+        measured=[hoststats for hoststats in self.hosts.itervalues() if hoststats['rate']]
+        if measured == []:
+            return None
+        rate_per_process=sum([hoststats['rate'] for hoststats in measured])/sum([hoststats['processes'] for hoststats in measured])
+        return rate_per_process*self.hosts[host]['processes']
+
+    def targets(self,number_remaining):
+        """The number of problems each host that is not lost should have
+pending."""
+        targets={}
+        alive_hosts=self.alive_hosts()
+        if alive_hosts == []:
+            return targets
+        rates=dict([(host,self.rate(host)) for host in alive_hosts])
+        if None in rates.values():
+            # nothing measured, share by processes
+            total_processes=sum([self.hosts[host]['processes'] for host in alive_hosts])
+            for host in alive_hosts:
+                share=int(m.ceil(float(number_remaining)*self.hosts[host]['processes']/total_processes))
+                targets[host]=max(self.hosts[host]['processes'],min(share,LIMITPERSEGMENT))
+        else:
+            # everything remaining is done in finish_time if shared by rate
+            finish_time=number_remaining/sum(rates.values())
+            for host in alive_hosts:
+                targets[host]=max(self.hosts[host]['processes'],int(m.ceil(rates[host]*min(finish_time,SCHEDULERHORIZON))))
+        return targets
+
+    def reclaim(self,idle_host):
+        """Find the host expected to finish last and how many of its
+problems to move to idle_host so both finish together.
+
+        **Returns**
+          tuple:
+            (host,number_to_reclaim), or (None,0) if nothing is worth
+            moving.
+
+        """
+        # only to hosts known to be running db_solver.py
+        idle_rate=self.hosts[idle_host]['rate']
+        if not idle_rate or self.hosts[idle_host]['lost']:
+            return None,0
+        slowest_host,slowest_finish=None,0.0
+        for host,hoststats in self.hosts.iteritems():
+            if host == idle_host or hoststats['pending'] == 0 or hoststats['lost']:
+                continue
+            finish_time=hoststats['pending']/self.rate(host)
+            if finish_time > slowest_finish:
+                slowest_host,slowest_finish=host,finish_time
+        if slowest_host is None:
+            return None,0
+        slowest_rate=self.rate(slowest_host)
+        idle_pending=self.hosts[idle_host]['pending']
+        number_to_reclaim=int((self.hosts[slowest_host]['pending']*idle_rate-idle_pending*slowest_rate)/(slowest_rate+idle_rate))
+        # not worth it unless it keeps the idle host busy
+        if number_to_reclaim < self.hosts[idle_host]['processes']:
+            return None,0
+        return slowest_host,number_to_reclaim
+
 # TODO: benchmark the random's
 def main(argv):
     global HOSTLIST
-    reductions=0
-    global LIMITPERSEGMENT
     # open connection to database
-    CONNECTION,CURSOR=open_database(None,None)
+    BACKEND=db_backend()
+    CONNECTION,CURSOR=BACKEND.connect()
     batch_table = argv[3]
+    LISTEN_CONNECTION=BACKEND.listen(batch_table)
+    SPECIFIC_LOGDIR=os.path.join(os.path.expanduser(TMPPATH+'/db_watcher_capture_output'),'db_watcher_'+timestamp_now()+'_'+batch_table)
+    os_makedirs(SPECIFIC_LOGDIR)
+    METRICS=DbMetrics(os.path.join(SPECIFIC_LOGDIR,'metrics.jsonl'),METRICSINTERVAL)
     if '--host-only' in sys.argv:
         HOSTLIST=[socket.gethostname()]
+    # --no-reclaim never moves work already assigned to a host
+    reclaim_flag='--no-reclaim' not in sys.argv
     # TODO: get host list
-    # TODO: get all hosts with unassigned work at once
-    selected_count_string="SELECT count(*) FROM " + batch_table + ";"
-    CURSOR.execute(selected_count_string)
-    selected=CURSOR.fetchall()
+    # leases are kept one row per host rather than on batch_table,
+    # so nothing here alters batch_table under the running hosts
+    BACKEND.create_lease_table(CONNECTION,CURSOR,batch_table)
+    number_of_problems=BACKEND.count_problems(CURSOR,batch_table)
     CONNECTION.commit()
-    print("Number of problems: %s" % selected[0][0])
-    # TODO: I should just count in database rather than moving whole thing...
+    print("Number of problems: %s" % number_of_problems)
+    scheduler=DbHostScheduler(HOSTLIST)
     while True:
-        # is amount of work to partition less than LIMIT*hosts, only reduce once
-        # only do if there is more than one host
-        # TODO: should I still do it if only one host
-        if len(HOSTLIST) > 1 and reductions < MAXREDUCTIONS:
-            selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE ORDER BY random();"
-            CURSOR.execute(selected_unassigned_string)
-            unassigned=CURSOR.fetchall()
-            if len(unassigned) < LIMITPERSEGMENT*len(HOSTLIST)*NOMINAL_PARITIONS:
-                # only reduce once, split up so each host gets assigned fourth times more on average
-                # allow assigning only 1 task for cases with small numbers of long running jobs
-                LIMITPERSEGMENT = max(TYPICAL_CORES,len(unassigned)/(len(HOSTLIST)*NOMINAL_PARITIONS))
-                print("Reduced limit per segment to: %s" % LIMITPERSEGMENT)
-                reductions += 1
+        METRICS.maybe_dump()
+        now=TIME_TIME()
+        # work of hosts that stopped renewing their leases, e.g.,
+        # because they crashed, goes back to being unassigned and the
+        # host gets no more until it shows it is running again
+        with METRICS.phase('lease expiry'):
+            number_expired=BACKEND.expire_leases(CURSOR,batch_table)
+        for host,number_expired_host in number_expired.iteritems():
+            print("Leases expired on %s problems of %s" % (number_expired_host,host))
+            scheduler.record_expired(host)
+            METRICS.count('leases expired',number_expired_host)
+        # one aggregate query rather than fetching rows, the pass costs
+        # the same whatever the size of the batch
+        with METRICS.phase('scan'):
+            counts=BACKEND.count_by_host(CURSOR,batch_table)
+        pending={}
         for host in HOSTLIST:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + host + "' AND done=FALSE;"
-            CURSOR.execute(selected_batch_string)
-            selected=CURSOR.fetchall()
-            # if the host has undone work, do not finish
-            if len(selected) >= TYPICAL_CORES:
+            pending[host],number_done=counts.get(host,(0,0))
+            scheduler.record_counts(host,pending[host],number_done,now)
+        number_unassigned=counts.get(None,(0,0))[0]
+        if number_unassigned == 0 and sum(pending.values()) == 0:
+            # we are done
+            CONNECTION.commit()
+            METRICS.dump()
+            return 0
+        targets=scheduler.targets(number_unassigned+sum(pending.values()))
+        for host in HOSTLIST:
+            if number_unassigned == 0:
+                break
+            if host not in targets:
+                # lost
                 continue
-            else:
-                selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE;"
-                CURSOR.execute(selected_unassigned_string)
-                unassigned=CURSOR.fetchall()
-                if unassigned == []:
-                    # we are done
-                    return 0
-                else:
-                    # assign a random-sized chunk of work for hostname, make sure if there are only a small number of problems they still get distributed
-                    # TODO: this might cause issues with many problems being sent out at very end..., we'll see
-                    # TODO: make this always assign at least TYICAL_CORES....
-                    #       number_to_assign is just used as a limit in sql statement, but not obvious from API whether it needs to be exact
-                    number_to_assign=max(TYPICAL_CORES,min(len(unassigned),LIMITPERSEGMENT))
-                    assign_work_chunk(CONNECTION,CURSOR,sys.argv[3],host,number_to_assign)
-        CONNECTION.commit()
-        time.sleep(CHECKDELAY)
+            # top up a host once it is running low, or is about to have
+            # idle processes
+            if pending[host] < max(scheduler.hosts[host]['processes'],SCHEDULERREFILL*targets[host]):
+                number_to_assign=min(number_unassigned,targets[host]-pending[host])
+                with METRICS.phase('assignment'):
+                    number_assigned=BACKEND.assign(CONNECTION,CURSOR,batch_table,host,number_to_assign,LEASETIME)
+                    BACKEND.notify(CURSOR,batch_table,'assigned ' + host)
+                number_unassigned-=number_assigned
+                pending[host]+=number_assigned
+                METRICS.count('assignments')
+        if number_unassigned == 0 and reclaim_flag:
+            # near the end of the batch, move work from the host expected
+            # to finish last to any host about to go idle, db_solver.py
+            # holds back all but a few chunks per process and drops
+            # anything moved before dispatching it
+            for host in HOSTLIST:
+                if pending[host] >= scheduler.hosts[host]['processes']:
+                    continue
+                slowest_host,number_to_reclaim=scheduler.reclaim(host)
+                if slowest_host is None:
+                    continue
+                with METRICS.phase('assignment'):
+                    number_reclaimed=BACKEND.reassign(CONNECTION,CURSOR,batch_table,slowest_host,host,number_to_reclaim)
+                    BACKEND.notify(CURSOR,batch_table,'assigned ' + host)
+                print("Reclaimed %s problems from %s for %s" % (number_reclaimed,slowest_host,host))
+                pending[slowest_host]-=number_reclaimed
+                pending[host]+=number_reclaimed
+                scheduler.hosts[slowest_host]['pending']=pending[slowest_host]
+                scheduler.hosts[host]['pending']=pending[host]
+                METRICS.count('reclaimed',number_reclaimed)
+        with METRICS.phase('commit'):
+            CONNECTION.commit()
+        # hosts only need more work after finishing some, check again
+        # when one does or after EVENTTIMEOUT in case an event was
+        # missed
+        with METRICS.phase('event wait'):
+            BACKEND.wait_for_event(LISTEN_CONNECTION,EVENTTIMEOUT,scheduler.record_event)
     CONNECTION.commit()
     CONNECTION.close()
 
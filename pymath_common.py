@@ -442,6 +442,86 @@ def open_database(connection,cursor):
             sys.exit(1)
     return connection,cursor
 
+@All(globals())
+def create_sweep(connection,cursor,dbtable,batch_table,solver_object,method_properties,ode_properties,grids,outgoing_properties,zipped=False,first_solve_number=0,chunk_size=65536):
+    """Create a dbtable with one problem for db_solver.py for each point
+of a parameter sweep, and add the problems to batch_table.  Rows are
+generated and loaded with COPY a chunk at a time, so memory stays the
+same however large the sweep.  Commits once everything is loaded.
+
+    **Parameters**
+      solver_object,method_properties,ode_properties:
+        Names of the solver object and property dictionaries,
+        stored as the '<<name>>' placeholders db_solver.py resolves.
+      grids:
+        A list of (name,array) incoming properties, each array 1-D.
+      outgoing_properties:
+        A list of (name,type) columns for the results, a "worker
+        time" column is always added.
+      zipped:
+        If True the grids have the same length and point i takes
+        element i of each, otherwise every combination is a point.
+      first_solve_number:
+        So that several sweeps can share one batch table.
+      chunk_size:
+        Number of problems generated and copied at once.
+
+    **Returns**
+      int:
+        The solve_number after the last problem created.
+
+    """
+    from cStringIO import StringIO
+    from db_common import db_copy_text
+    names=[name for name,grid in grids]
+    grids=[np.asarray(grid).ravel() for name,grid in grids]
+    if zipped:
+        if len(set([len(grid) for grid in grids])) > 1:
+            raise ValueError("Zipped grids must all be the same length!!!")
+        number_of_points=len(grids[0])
+    else:
+        shape=tuple([len(grid) for grid in grids])
+        number_of_points=int(np.prod(shape))
+    column_types={'b':'boolean','i':'bigint','u':'bigint','f':'double precision','S':'text','U':'text'}
+    incoming_columns=[]
+    for name,grid in zip(names,grids):
+        if grid.dtype.kind not in column_types:
+            raise TypeError("No column type for grid %s with dtype: %s" % (name,grid.dtype))
+        incoming_columns.append('"' + name + '" ' + column_types[grid.dtype.kind])
+    outgoing_columns=['"' + name + '" ' + thetype for name,thetype in outgoing_properties]
+    cursor.execute("CREATE TABLE " + dbtable + " (solve_number integer PRIMARY KEY, solver_object text, method_properties text, ode_properties text, incoming_properties_keys text[], outgoing_properties_keys text[], " + ', '.join(incoming_columns + outgoing_columns + ['"worker time" double precision']) + ");")
+    cursor.execute("CREATE TABLE IF NOT EXISTS " + batch_table + " (table_name text, solve_number integer PRIMARY KEY, hostname text, done boolean);")
+    # the same for every row, so converted once
+    spec_text='\t'.join([db_copy_text('<<' + solver_object.strip('<>') + '>>'),
+                         db_copy_text('<<' + method_properties.strip('<>') + '>>'),
+                         db_copy_text('<<' + ode_properties.strip('<>') + '>>'),
+                         db_copy_text(names),
+                         db_copy_text([name for name,thetype in outgoing_properties])])
+    batch_text=db_copy_text(dbtable)
+    dbtable_copy_string="COPY " + dbtable + " (" + ','.join(['solve_number','solver_object','method_properties','ode_properties','incoming_properties_keys','outgoing_properties_keys'] + ['"' + name + '"' for name in names]) + ") FROM STDIN;"
+    batch_copy_string="COPY " + batch_table + " (table_name,solve_number,hostname,done) FROM STDIN;"
+    for start in xrange(0,number_of_points,chunk_size):
+        stop=min(start+chunk_size,number_of_points)
+        if zipped:
+            columns=[grid[start:stop] for grid in grids]
+        else:
+            # only this chunk of the combinations is ever expanded
+            indices=np.unravel_index(np.arange(start,stop),shape)
+            columns=[grid[index] for grid,index in zip(grids,indices)]
+        dbtable_buffer=StringIO()
+        batch_buffer=StringIO()
+        for i in xrange(stop-start):
+            solve_number_text=str(first_solve_number+start+i)
+            dbtable_buffer.write(solve_number_text + '\t' + spec_text + '\t' + '\t'.join([db_copy_text(column[i]) for column in columns]) + '\n')
+            batch_buffer.write(batch_text + '\t' + solve_number_text + '\t\\N\tf\n')
+        dbtable_buffer.seek(0)
+        batch_buffer.seek(0)
+        cursor.copy_expert(dbtable_copy_string,dbtable_buffer)
+        cursor.copy_expert(batch_copy_string,batch_buffer)
+        print("Loaded %s of %s problems into %s" % (stop,number_of_points,dbtable))
+    connection.commit()
+    return first_solve_number+number_of_points
+
 @All(globals())
 def pymath_db_setup(theglobals,thelocals):
     # TODO: open database and add things to globals